@@ -4,10 +4,12 @@ import numpy as np
 import jax
 import tqdm
 from flax import struct, jax_utils
+from config import ImagenConfig
 
 max_sequence_length = 512
-name = "t5-large"
-def get_tokenizer_and_model():
+# the unets are built for the embedding size of this model (UnetConfig.token_embedding_dim)
+name = ImagenConfig().text_encoder_name
+def get_tokenizer_and_model(name=name):
     tokenizer = T5Tokenizer.from_pretrained(name)
     model = FlaxT5ForConditionalGeneration.from_pretrained(name)
     return tokenizer, model
@@ -34,6 +36,61 @@ def encode_texts(input_ids, attention_mask, model):
     
     return outputs[0], attention_mask
 
+class TextEncoder:
+    """Encodes any number of captions with the pmapped encoder, batched by token length.
+
+    Captions are tokenized without padding, grouped into length buckets and packed into fixed
+    (devices, per_device_batch, bucket) arrays, so the encoder only ever compiles one program per bucket
+    and short captions never run through 512 positions. Results come back at their true length, in
+    request order.
+    """
+
+    def __init__(self, tokenizer=None, model=None, per_device_batch=16, length_buckets=(32, 64, 128, 256, 512), name=name):
+        if tokenizer is None or model is None:
+            tokenizer, model = get_tokenizer_and_model(name)
+        self.tokenizer = tokenizer
+        self.model = model
+        self.embedding_dim = model.config.d_model
+        self.num_devices = jax.local_device_count()
+        self.per_device_batch = per_device_batch
+        self.length_buckets = length_buckets
+
+    def bucket(self, length):
+        return next((bucket for bucket in self.length_buckets if length <= bucket), self.length_buckets[-1])
+
+    def encode(self, texts):
+        input_ids = self.tokenizer(list(texts), padding=False, max_length=max_sequence_length, truncation=True).input_ids
+        lengths = np.array([len(ids) for ids in input_ids])
+        buckets = np.array([self.bucket(length) for length in lengths])
+        device_batch = self.num_devices * self.per_device_batch
+        outputs = [None] * len(texts)
+        for bucket in np.unique(buckets):
+            indices = np.nonzero(buckets == bucket)[0]
+            for start in range(0, len(indices), device_batch):
+                chunk = indices[start:start + device_batch]
+                # unused rows stay padding, every call of a bucket has the same shape
+                ids = np.full((device_batch, bucket), self.tokenizer.pad_token_id, dtype=np.int32)
+                attention_mask = np.zeros((device_batch, bucket), dtype=np.int32)
+                for row, index in enumerate(chunk):
+                    ids[row, :lengths[index]] = input_ids[index]
+                    attention_mask[row, :lengths[index]] = 1
+                encoded, _ = encode_texts(
+                    ids.reshape(self.num_devices, -1, bucket), attention_mask.reshape(self.num_devices, -1, bucket), self.model)
+                encoded = np.asarray(encoded).reshape(device_batch, bucket, -1)
+                for row, index in enumerate(chunk):
+                    outputs[index] = encoded[row, :lengths[index]]
+        return outputs
+
+    def encode_requests(self, requests):
+        # several callers' captions are packed into the same device batches, results are split per request
+        outputs = self.encode([text for texts in requests for text in texts])
+        results = []
+        for texts in requests:
+            results.append(outputs[:len(texts)])
+            outputs = outputs[len(texts):]
+        return results
+
+
 def test():
     tokenizer, model = get_tokenizer_and_model()
     text = ["This is a test"] * 1024
@@ -43,7 +100,7 @@ def test():
         attention_mask = np.array(attention_mask).reshape(8, -1, 512)
         encoded, attention_mask = encode_texts(input_ids, attention_mask, model)
         print(encoded.shape)
-        encoded = np.array(encoded).reshape(-1, 512, 1024)
+        encoded = np.array(encoded).reshape(-1, 512, model.config.d_model)
         attention_mask = np.array(attention_mask).reshape(-1, 512)
         
 if __name__ == "__main__":
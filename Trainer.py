@@ -1,6 +1,7 @@
-from T5Utils import encode_text, get_tokenizer_and_model
+from T5Utils import TextEncoder
 import numpy as np
 from imagen_main import Imagen
+import jax
 import jax.numpy as jnp
 from tqdm import tqdm
 from flax.training import checkpoints
@@ -8,11 +9,14 @@ import tensorflow_datasets as tfds
 import wandb
 import time
 import os
-from T5Utils import get_tokenizer_and_model, encode_text
 
 import pickle
-from dataset_utils import get_cifar100, get_mnist
+import json
+from dataset_utils import augment_image_pyramid, get_cifar100, get_mnist, make_image_pyramid
 from config import ImagenConfig
+from embedding_cache import EmbeddingCache
+from text_embeddings import pad_embeddings
+from shards import SHARD_SUFFIX, ShardDataset, ShardWriter, list_shards
 from jax.config import config as jax_config
 import random
 
@@ -21,6 +25,7 @@ class Trainer:
         wandb.init(project="imagen", entity="apcsc")
         
         config = ImagenConfig()
+        self.config = config
         
         wandb.config.batch_size = config.batch_size
         wandb.config.seed = 0
@@ -28,53 +33,95 @@ class Trainer:
         wandb.config.image_size = 64
         wandb.config.save_every = 1_000_000
         wandb.config.eval_every = 500
-        self.images, self.labels = get_mnist()
-        self.tokenizer, self.model = get_tokenizer_and_model()
-        # batch encode the text
-        SAVE = False
+        wandb.config.dataset_dir = "shards/mnist"
+        # random resized crops, applied on the host while the batch is assembled
+        wandb.config.augment = True
+        # random horizontal flips as well, off for digits: a mirrored "2" no longer matches its caption
+        wandb.config.flip = "mnist" not in wandb.config.dataset_dir
+        # checkpoint directory to continue from, e.g. ckpt/<run id>/checkpoint_<step>
+        wandb.config.resume_from = os.environ.get("RESUME_FROM")
+        self.text_encoder = TextEncoder(name=config.text_encoder_name)
+        for unet_config in config.unets:
+            assert unet_config.token_embedding_dim == self.text_encoder.embedding_dim, \
+                f"{config.text_encoder_name} embeddings have {self.text_encoder.embedding_dim} dims, the unets expect {unet_config.token_embedding_dim}"
+        # the labels repeat constantly, so each distinct caption only goes through T5 once
+        self.embedding_cache = EmbeddingCache(config.text_encoder_name, "cache/embeddings")
         np.random.seed(wandb.config.seed)
         random.seed(wandb.config.seed)
-        if os.path.exists("batches.npy"):
-            with open("batches.npy", "rb") as f:
-                self.batches = pickle.load(f)
-                f.close()
-            print("Loaded batches from file")
-        else:
-            self.batches = []
-            for i in tqdm(range(len(self.labels)//wandb.config.batch_size)):
-                batch_labels = self.labels[i *
-                                           wandb.config.batch_size:(i+1)*wandb.config.batch_size]
-                batch_images = self.images[i *
-                                           wandb.config.batch_size:(i+1)*wandb.config.batch_size]
-                batch_labels_encoded, attention_masks = encode_text(
-                    batch_labels, self.tokenizer, self.model)
-                batch_labels_encoded = np.asarray(batch_labels_encoded)
-                self.batches.append(
-                    (batch_images, batch_labels_encoded, attention_masks))
-            # save the batches to disk as pickle
-            if SAVE:
-                with open("batches.npy", "wb") as f:
-                    pickle.dump(self.batches, f)
-                    f.close()
-                    print("Saved batches to disk")
-        print("Loaded batches, now preparing imagen")
+        if not os.path.exists(wandb.config.dataset_dir):
+            self.write_shards(wandb.config.dataset_dir)
+        # batches are read from memory-mapped shards, so the dataset does not have to fit in host memory
+        self.dataset = ShardDataset(list_shards(wandb.config.dataset_dir), wandb.config.batch_size, seed=wandb.config.seed,
+                                    text_length_buckets=config.text_length_buckets, bucket_by_length=True)
+        print(f"Loaded {self.dataset.num_examples} examples, now preparing imagen")
         # jax_config.update("jax_debug_nans", True)
         self.imagen = Imagen(config=config)
+        self.imagen.compile_train_steps()
+        self.step = 0
+        if wandb.config.resume_from:
+            self.restore(wandb.config.resume_from)
         print("Prepared imagen, now begining training")
 
+    def save(self, step):
+        checkpoint_dir = f"ckpt/{wandb.run.id}/checkpoint_{step}"
+        checkpoints.save_checkpoint(checkpoint_dir, self.imagen.state_dict(), step=step)
+        # the data order is saved with the weights, so a resumed run continues with the next unseen batch
+        with open(os.path.join(checkpoint_dir, "data_state.json.tmp"), "w") as f:
+            json.dump({"step": step, "dataset": self.dataset.state_dict()}, f)
+        os.replace(os.path.join(checkpoint_dir, "data_state.json.tmp"), os.path.join(checkpoint_dir, "data_state.json"))
+        wandb.save(f"{checkpoint_dir}/*")
+
+    def restore(self, checkpoint_dir):
+        self.imagen.load_state_dict(checkpoints.restore_checkpoint(checkpoint_dir, target=jax.device_get(self.imagen.state_dict())))
+        with open(os.path.join(checkpoint_dir, "data_state.json"), "r") as f:
+            data_state = json.load(f)
+        self.dataset.load_state_dict(data_state["dataset"])
+        self.step = data_state["step"]
+        print(f"Resumed from {checkpoint_dir} at step {self.step}, epoch {self.dataset.epoch}, batch {self.dataset.position}")
+
+    def encode_text(self, texts):
+        # embeddings at their true length, use embedding_cache.encode for a padded batch
+        return self.embedding_cache.lookup(texts, self.text_encoder.encode)
+
+    def write_shards(self, directory, shard_size=10_000):
+        # one-off conversion of the in-memory dataset into shards with precomputed text embeddings
+        images, labels = get_mnist()
+        images = np.round((images + 1) * 127.5).astype(np.uint8)
+        os.makedirs(directory + ".tmp", exist_ok=True)
+        batch_size = wandb.config.batch_size
+        for shard_index, start in enumerate(range(0, len(labels), shard_size)):
+            with ShardWriter(os.path.join(directory + ".tmp", f"mnist_{shard_index:05d}{SHARD_SUFFIX}"), image_shape=images.shape[1:]) as writer:
+                for i in tqdm(range(start, min(start + shard_size, len(labels)), batch_size)):
+                    batch_labels = labels[i:min(i + batch_size, start + shard_size)]
+                    writer.add_batch(images[i:i + len(batch_labels)], batch_labels, self.encode_text(batch_labels))
+        os.replace(directory + ".tmp", directory)
+        print(f"Wrote {len(labels)} examples to {directory}")
+
     def train(self):
-        pbar = tqdm(range(1, 1_000_001))
-        step = 0
-        passes = 0
         timesteps_per_image = 1
+        step = self.step
+        passes = step * timesteps_per_image
+        pbar = tqdm(range(1, 1_000_001), initial=passes)
         while True:
             step += 1
-            key = np.random.randint(0, len(self.batches) - 1)
-            images, captions_encoded, attention_masks = self.batches[key]
+            data_start_time = time.time()
+            batch = self.dataset.next_batch()
+            images = batch["images"].astype(np.float32) / 127.5 - 1
+            captions_encoded = batch["embeddings"]
+            attention_masks = batch["attention_masks"]
             # images, captions, captions_encoded, attention_masks = ray.get(self.datacollector.get_batch.remote())
-            images = jnp.array(images)
+            # every unet's target resolution is built once per batch on the host
+            if wandb.config.augment:
+                # seeded by step, so a resumed run draws the same augmentations
+                rng = np.random.default_rng([wandb.config.seed, step])
+                pyramid = augment_image_pyramid(images, self.config.image_sizes, rng, flip=wandb.config.flip)
+            else:
+                pyramid = make_image_pyramid(images, self.config.image_sizes)
+            images = [jnp.array(level) for level in pyramid]
             captions_encoded = jnp.array(captions_encoded)
             attention_masks = jnp.array(attention_masks)
+            # host time spent assembling the batch, the step waits on it
+            data_seconds = time.time() - data_start_time
 
             for ts in range(timesteps_per_image):
                 passes += 1
@@ -85,6 +132,7 @@ class Trainer:
                 pbar.update(1)
                 metrics["images_per_second"] = wandb.config.batch_size / \
                     (time.time() - start_time)
+                metrics["data_seconds"] = data_seconds
                 #  metrics["loss"] = np.asarray(metrics["loss"])
                 # metrics["loss"] = np.mean(metrics["loss"])
                 # print(metrics)
@@ -93,9 +141,7 @@ class Trainer:
             if step % wandb.config.save_every == 0:
                 if not os.path.exists(f"ckpt/{wandb.run.id}/"):
                     os.makedirs(f"ckpt/{wandb.run.id}/")
-                checkpoints.save_checkpoint(
-                    f"ckpt/{wandb.run.id}/checkpoint_{step}", self.imagen.imagen_state, step=step)
-                wandb.save(f"ckpt/{wandb.run.id}/checkpoint_{step}.pkl")
+                self.save(step)
 
             if step % wandb.config.eval_every == 0:
                 prompts = [
@@ -110,8 +156,7 @@ class Trainer:
                 ]
                 prompts = [f"An image of the number {i}" for i in range(1, 9)]
                 
-                prompts_encoded, attention_masks = encode_text(
-                    prompts, self.tokenizer, self.model)
+                prompts_encoded, attention_masks = pad_embeddings(self.encode_text(prompts))
                 prompts_encoded = jnp.array(prompts_encoded)
                 attention_masks = jnp.array(attention_masks)
                 imgs = self.imagen.sample(
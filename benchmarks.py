@@ -0,0 +1,104 @@
+import sys
+import time
+
+import jax
+import jax.numpy as jnp
+from einops import rearrange
+
+from config import ImagenConfig
+from layers import Attention, LayerNorm
+
+
+def time_fn(fn, *args, iters=50):
+    # first call compiles
+    jax.block_until_ready(fn(*args))
+    start_time = time.time()
+    for _ in range(iters):
+        out = fn(*args)
+    jax.block_until_ready(out)
+    return (time.time() - start_time) / iters
+
+
+def unet_feature_shapes(config: ImagenConfig, batch_size=None):
+    # feature maps seen by the transformer blocks of every EfficentUNet, one entry per resolution stage
+    batch_size = batch_size or config.batch_size
+    shapes = []
+    for unet_config, image_size in zip(config.unets, config.image_sizes):
+        size = image_size
+        for block_config in unet_config.block_configs:
+            size = size // 2
+            shapes.append((unet_config, block_config, (batch_size, size, size, block_config.dim)))
+    return shapes
+
+
+def two_pass_layer_norm(x, g, eps=1e-3):
+    var = jnp.var(x, axis=-1, keepdims=True)
+    mean = jnp.mean(x, axis=-1, keepdims=True)
+    return (x - mean) / jnp.sqrt(var + eps) * g
+
+
+def benchmark_layernorm(config=ImagenConfig(), dtype=jnp.bfloat16):
+    key = jax.random.PRNGKey(0)
+    for _, _, shape in unet_feature_shapes(config):
+        x = jax.random.normal(key, shape, dtype=dtype)
+        for name, x in (("channel", x), ("attention", rearrange(x, 'b h w c -> b (h w) c'))):
+            layer = LayerNorm()
+            params = layer.init(key, x)
+            g = params["params"]["g"]
+            fused = jax.jit(lambda params, x: layer.apply(params, x))
+            reference = jax.jit(two_pass_layer_norm)
+            fused_time = time_fn(fused, params, x)
+            reference_time = time_fn(reference, x, g)
+            print(f"LayerNorm {name} {x.shape}: single pass {fused_time * 1e3:0.3f}ms, "
+                  f"two pass {reference_time * 1e3:0.3f}ms ({reference_time / fused_time:0.2f}x)")
+
+
+def multi_head_broadcast_attention(q, k, v):
+    # the contraction Attention used before the folded layout, one k/v head broadcast across the query heads
+    sim = jnp.einsum('b h i d, b j d -> b h i j', q, k)
+    attn = jax.nn.softmax(sim, axis=-1)
+    return jnp.einsum('b h i j, b j d -> b h i d', attn, v)
+
+
+def benchmark_attention(config=ImagenConfig(), dtype=jnp.bfloat16):
+    # the replaced broadcast contraction as the baseline, next to the Attention module as it ships, once per
+    # number of k/v heads (num_heads is plain multi-head attention). The module times include its projections
+    key = jax.random.PRNGKey(0)
+    for unet_config, block_config, (b, h, w, c) in unet_feature_shapes(config):
+        if block_config.num_heads == 0:
+            continue
+        n, heads, dim_heads = h * w, block_config.num_heads, unet_config.dim_heads
+        q = jax.random.normal(key, (b, heads, n, dim_heads), dtype=dtype)
+        k, v = jax.random.normal(key, (2, b, n + 1, dim_heads), dtype=dtype)
+        reference_time = time_fn(jax.jit(multi_head_broadcast_attention), q, k, v)
+        x = jax.random.normal(key, (b, n, c), dtype=dtype)
+        timings = []
+        for kv_heads in sorted({1, block_config.num_kv_heads, block_config.num_heads}):
+            attention = Attention(config=unet_config, block_config=block_config.replace(num_kv_heads=kv_heads))
+            params = attention.init(key, x)
+            apply = jax.jit(lambda params, x, attention=attention: attention.apply(params, x))
+            timings.append(f"{kv_heads} kv heads {time_fn(apply, params, x) * 1e3:0.3f}ms")
+        print(f"Attention {h}x{w} ({heads} heads): broadcast einsum {reference_time * 1e3:0.3f}ms, module " + ", ".join(timings))
+
+
+def benchmark_sampling(config=ImagenConfig(), batch_size=64, microbatch_size=16):
+    from imagen_main import Imagen
+    imagen = Imagen(config=config)
+    texts = jnp.ones((batch_size, config.unets[0].max_token_len, config.unets[0].token_embedding_dim))
+    attention = jnp.ones((batch_size, config.unets[0].max_token_len))
+    for name, sample in (("sequential", lambda: imagen.sample(texts, attention)),
+                         ("pipelined", lambda: imagen.sample_pipelined(texts, attention, microbatch_size))):
+        sample_time = time_fn(sample, iters=3)
+        print(f"Sampling {name}: {batch_size / sample_time:0.2f} images/sec")
+
+
+BENCHMARKS = {
+    "layernorm": benchmark_layernorm,
+    "attention": benchmark_attention,
+    "sampling": benchmark_sampling,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -14,11 +14,14 @@ def SingleOrTuple(inner_type):
 class BlockConfig(struct.PyTreeNode):
     dim:                       int = 128
     num_heads:                 int = 4
+    num_kv_heads:              int = 1  # 1 = multi-query attention, num_heads = multi-head attention
     num_resnet_blocks:         int = 8
     self_attention:            bool = True
     cross_attention:           bool = True
     
     attention_depth:          int = 1
+    attention_window:         int = 0  # 0 = global attention over the whole feature map
+    shifted_windows:          bool = True  # shift every other windowed attention layer by half a window
         
 
 class UnetConfig(struct.PyTreeNode):
@@ -59,7 +62,10 @@ class UnetConfig(struct.PyTreeNode):
             time_cond_dim:          int=None,
             
             num_heads:              SingleOrTuple(int)=4,
+            num_kv_heads:           SingleOrTuple(int)=1,
             num_resnet_blocks:      SingleOrTuple(int)=8,
+            attention_depth:        SingleOrTuple(int)=1,
+            attention_window:       SingleOrTuple(int)=0,
             
             lowres_conditioning:    bool=False,
             scheduler:              str="cosine",
@@ -68,13 +74,19 @@ class UnetConfig(struct.PyTreeNode):
         block_configs = []
         for i in range(len(dim_mults)):
             n_heads = num_heads if isinstance(num_heads, int) else num_heads[i]
+            n_kv_heads = num_kv_heads if isinstance(num_kv_heads, int) else num_kv_heads[i]
+            if n_heads > 0:
+                assert n_heads % n_kv_heads == 0, f"num_heads ({n_heads}) must be divisible by num_kv_heads ({n_kv_heads})"
             n_resnet_blocks = num_resnet_blocks if isinstance(num_resnet_blocks, int) else num_resnet_blocks[i]
-            depth = 1
+            depth = attention_depth if isinstance(attention_depth, int) else attention_depth[i]
+            window = attention_window if isinstance(attention_window, int) else attention_window[i]
             block_configs.append(BlockConfig(
                 dim=dim * dim_mults[i],
                 num_heads=n_heads,
+                num_kv_heads=n_kv_heads,
                 num_resnet_blocks=n_resnet_blocks,
                 attention_depth=depth,
+                attention_window=window,
             ))
         if cond_dim is None:
             cond_dim = dim
@@ -122,3 +134,6 @@ class ImagenConfig(struct.PyTreeNode):
     
     batch_size:             int = 128
 
+    # text batches are padded to one of these lengths, each gets its own compiled train step
+    text_length_buckets:    Tuple[int] = struct.field(pytree_node=False, default=(32, 64, 128, 256))
+
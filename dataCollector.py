@@ -13,7 +13,12 @@ from dataset_utils import load_dataset
 from datasets.utils.file_utils import get_datasets_user_agent
 
 import ray
-from T5Utils import encode_text, get_tokenizer_and_model
+from ring_buffer import RaggedRingBuffer, RingBuffer
+from flow_control import Watermarks
+from metrics import StageMetrics
+import T5Utils
+from embedding_cache import EmbeddingCache
+from text_embeddings import pad_ragged, to_ragged
 import tensorflow_datasets as tfds
 import cv2
 import time
@@ -52,58 +57,52 @@ def fetch_images(batch, num_threads, timeout=None, retries=0):
 
 @ray.remote(resources={"host": 1})
 class SharedStorage:
-    def __init__(self):
-        self.images = []
-        self.texts = []
-        self.texts_encoded = []
-        self.attention_masks = []
-
-        self.images_unencoded = []
-        self.texts_unencoded = []
+    def __init__(self, capacity=1_000 * 64, token_capacity=1_000 * 64 * 32):
+        # embeddings are buffered at their true length and only padded when a batch is taken out
+        self.encoded = RaggedRingBuffer(capacity, token_capacity)
+        self.unencoded = RingBuffer(capacity)
+        # collectors block while the unencoded buffer is full, processors while the encoded one is
+        self.encoded_watermarks = Watermarks(lambda: len(self.encoded), high=capacity)
+        self.unencoded_watermarks = Watermarks(lambda: len(self.unencoded), high=capacity)
+        self.encoded_metrics = StageMetrics("storage.encoded")
+        self.unencoded_metrics = StageMetrics("storage.unencoded")
 
     def get_encoded_size(self):
-        return len(self.images)
+        return len(self.encoded)
 
     def get_unencoded_size(self):
-        return len(self.images_unencoded)
-
-    def add_data(self, images, texts):
-        self.images_unencoded.extend(images)
-        self.texts_unencoded.extend(texts)
-        # print(len(self.images_unencoded))
-
-    def add_data_encoded(self, images, texts, texts_encoded, attention_masks):
-        self.images.extend(images)
-        self.texts.extend(texts)
-        self.texts_encoded.extend(texts_encoded)
-        self.attention_masks.extend(attention_masks)
-
-    def get_batch(self, batch_size):
-        if len(self.images) < batch_size:
-            return None
-        images = []
-        texts = []
-        texts_encoded = []
-        attention_masks = []
-        for _ in range(batch_size):
-            images.append(self.images.pop(0))
-            texts.append(self.texts.pop(0))
-            texts_encoded.append(self.texts_encoded.pop(0))
-            attention_masks.append(self.attention_masks.pop(0))
-        images = np.array(images)
-        texts_encoded = np.array(texts_encoded)
-        attention_masks = np.array(attention_masks)
-        return images, texts, texts_encoded, attention_masks
-
-    def get_batch_unencoded(self, batch_size):
-        if len(self.images_unencoded) < batch_size:
-            return None
-        images = self.images_unencoded[:batch_size]
-        texts = self.texts_unencoded[:batch_size]
-        self.images_unencoded = self.images_unencoded[batch_size:]
-        self.texts_unencoded = self.texts_unencoded[batch_size:]
-        images = np.array(images)
-        return images, texts
+        return len(self.unencoded)
+
+    async def add_data(self, images, texts):
+        await self.unencoded_watermarks.wait_for_space()
+        self.unencoded.put(images=images, texts=texts)
+        await self.unencoded_watermarks.changed()
+        self.unencoded_metrics.count(items_in=len(texts))
+        self.unencoded_metrics.set_queue_depth(len(self.unencoded))
+
+    async def add_data_encoded(self, images, texts, embedding_values, embedding_lengths):
+        await self.encoded_watermarks.wait_for_space()
+        self.encoded.put(embedding_values, embedding_lengths, images=images, texts=texts)
+        await self.encoded_watermarks.changed()
+        self.encoded_metrics.count(items_in=len(texts))
+        self.encoded_metrics.set_queue_depth(len(self.encoded))
+
+    async def get_batch(self, batch_size):
+        await self.encoded_watermarks.wait_for(batch_size)
+        batch = self.encoded.get(batch_size)
+        await self.encoded_watermarks.changed()
+        self.encoded_metrics.count(items_out=batch_size)
+        self.encoded_metrics.set_queue_depth(len(self.encoded))
+        texts_encoded, attention_masks = pad_ragged(batch["values"], batch["lengths"])
+        return batch["images"], batch["texts"].tolist(), texts_encoded, attention_masks
+
+    async def get_batch_unencoded(self, batch_size):
+        await self.unencoded_watermarks.wait_for(batch_size)
+        batch = self.unencoded.get(batch_size)
+        await self.unencoded_watermarks.changed()
+        self.unencoded_metrics.count(items_out=batch_size)
+        self.unencoded_metrics.set_queue_depth(len(self.unencoded))
+        return batch["images"], batch["texts"].tolist()
 
 
 @ray.remote(num_cpus=5, resources={"host": 1})
@@ -148,19 +147,20 @@ class DataCollector:
         self.shared_storage = shared_storage
         self.dataset = dataset
         self.images_collected = 0
+        self.metrics = StageMetrics("collect")
 
     def collect(self):
         while True:
-            if ray.get(self.shared_storage.get_unencoded_size.remote()) > 1_000*64 or ray.get(self.shared_storage.get_encoded_size.remote()) > 1_000 * 64:
-                time.sleep(10)
-                continue
             images = []
             labels = []
-            batches = ray.get(self.dataset.get_data.remote())
-            for batch in zip(*batches):
-                image, label = batch
-                images.append(image)
-                labels.append(str(label))
+            with self.metrics.idle():
+                batches = ray.get(self.dataset.get_data.remote())
+            with self.metrics.busy(len(batches[0])):
+                for batch in zip(*batches):
+                    image, label = batch
+                    images.append(image)
+                    labels.append(str(label))
+            self.metrics.count(items_out=len(images))
             """
             item = ray.get(item)
             image = fetch_single_image(item["image_url"])
@@ -170,17 +170,24 @@ class DataCollector:
             if image.shape != (64, 64, 3):
                 continue
             """
-            self.shared_storage.add_data.remote(images, labels)
+            # blocks while the storage is above its high watermark
+            with self.metrics.idle():
+                ray.get(self.shared_storage.add_data.remote(images, labels))
 
 
 @ray.remote(resources={"tpu": 1})
 class T5Encoder:
     def __init__(self):
-        self.tokenizer, self.model = get_tokenizer_and_model()
+        self.text_encoder = T5Utils.TextEncoder()
+        self.embedding_cache = EmbeddingCache(T5Utils.name, "cache/embeddings")
+        self.metrics = StageMetrics("t5_encode")
 
     def encode(self, texts):
-        logits, attention_mask = encode_text(texts, self.tokenizer, self.model)
-        return np.asarray(logits), np.asarray(attention_mask)
+        # packed (values, lengths), see text_embeddings.to_ragged
+        with self.metrics.busy(len(texts)):
+            encoded = to_ragged(self.embedding_cache.lookup(texts, self.text_encoder.encode))
+        self.metrics.count(items_out=len(texts))
+        return encoded
 
 
 @ray.remote
@@ -191,13 +198,11 @@ class Processor:
 
     def start_encoding(self):
         while True:
-            out = ray.get(self.shared_storage.get_batch_unencoded.remote(32))
-            if out:
-                images, texts = out
-                texts_encoded, attention_masks = ray.get(
-                    self.encoder.encode.remote(texts))
-                self.shared_storage.add_data_encoded.remote(
-                    images, texts, texts_encoded, attention_masks)
+            images, texts = ray.get(self.shared_storage.get_batch_unencoded.remote(32))
+            embedding_values, embedding_lengths = ray.get(
+                self.encoder.encode.remote(texts))
+            ray.get(self.shared_storage.add_data_encoded.remote(
+                images, texts, embedding_values, embedding_lengths))
 
 
 @ray.remote(num_cpus=2, resources={"host": 1})
@@ -210,6 +215,8 @@ class DataManager:
             self.shared_storage, self.datasetFetcher) for _ in range(num_workers)]
         self.processors = [Processor.remote(self.shared_storage)
                            for _ in range(2)]
+        # how long the trainer waits for batches
+        self.metrics = StageMetrics("consume")
         
     def start(self):
         for worker in self.workers:
@@ -218,8 +225,8 @@ class DataManager:
             processor.start_encoding.remote()
 
     def get_batch(self):
-        data = None
-        while data is None:
-            data = ray.get(
-                self.shared_storage.get_batch.remote(self.batch_size))
-        return data
+        # blocks in the storage until a full batch is buffered
+        with self.metrics.idle():
+            batch = ray.get(self.shared_storage.get_batch.remote(self.batch_size))
+        self.metrics.count(items_out=self.batch_size)
+        return batch
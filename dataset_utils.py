@@ -3,6 +3,95 @@ import tensorflow_datasets as tfds
 import cv2
 import sklearn
 
+def resize_images(images, size):
+    # antialiased resize of a (b, h, w, c) batch to (b, size, size, c)
+    b, h, w, c = images.shape
+    if h == size and w == size:
+        return images
+    if h % size == 0 and w % size == 0:
+        # integer downsampling factor: exact box filter, vectorized over the whole batch
+        boxed = images.reshape(b, size, h // size, size, w // size, c).mean(axis=(2, 4))
+        return boxed.astype(images.dtype)
+    interpolation = cv2.INTER_AREA if size < h else cv2.INTER_CUBIC
+    resized = [cv2.resize(image, (size, size), interpolation=interpolation) for image in images]
+    return np.stack(resized, axis=0).reshape(b, size, size, c)
+
+
+def make_image_pyramid(images, image_sizes):
+    """Resize a batch once to every resolution of the cascade (one entry per unet in ImagenConfig.image_sizes)."""
+    images = np.asarray(images)
+    return tuple(resize_images(images, size) for size in image_sizes)
+
+
+def _box_reduce(images):
+    # halves a (b, h, w, c) batch with a 2x2 box filter, an odd last row or column is dropped
+    b, h, w, c = images.shape
+    images = images[:, :h // 2 * 2, :w // 2 * 2]
+    return images.reshape(b, h // 2, 2, w // 2, 2, c).mean(axis=(2, 4), dtype=np.float32)
+
+
+def random_crop_boxes(rng, batch_size, height, width, min_scale=0.64, max_scale=1.0):
+    # square crops covering min_scale..max_scale of the largest square's area, at uniform random positions
+    side = min(height, width) * np.sqrt(rng.uniform(min_scale, max_scale, batch_size))
+    top = rng.uniform(0, 1, batch_size) * (height - side)
+    left = rng.uniform(0, 1, batch_size) * (width - side)
+    return top, left, side
+
+
+def crop_resize(levels, top, left, side, size, flip=None):
+    """Bilinear resample of the square crop (top, left, side) of every image to (size, size), vectorized over the batch.
+
+    levels[k] is the batch box reduced k times by 2 (see _box_reduce). The crop is sampled from the most reduced
+    level that is still at least as large as the output, so the bilinear step never shrinks by 2x or more and
+    the result is antialiased. Images where flip is set are mirrored horizontally.
+    """
+    b = len(top)
+    scale = side / size
+    k = min(max(int(np.floor(np.log2(scale.min()))), 0), len(levels) - 1)
+    images = levels[k]
+    _, h, w, _ = images.shape
+    # centers of the output pixels in the coordinates of the level, with pixel i centered at i
+    centers = np.arange(size) + 0.5
+    ys = (top[:, None] + centers * scale[:, None]) / 2 ** k - 0.5
+    xs = (left[:, None] + centers * scale[:, None]) / 2 ** k - 0.5
+    if flip is not None:
+        xs = np.where(flip[:, None], xs[:, ::-1], xs)
+    ys = np.clip(ys, 0, h - 1)
+    xs = np.clip(xs, 0, w - 1)
+    y0 = np.floor(ys).astype(np.int32)
+    x0 = np.floor(xs).astype(np.int32)
+    y1 = np.minimum(y0 + 1, h - 1)
+    x1 = np.minimum(x0 + 1, w - 1)
+    wy = (ys - y0).astype(np.float32)[:, :, None, None]
+    wx = (xs - x0).astype(np.float32)[:, None, :, None]
+    batch = np.arange(b)[:, None, None]
+
+    def gather(y, x):
+        return images[batch, y[:, :, None], x[:, None, :]]
+
+    top_row = gather(y0, x0) * (1 - wx) + gather(y0, x1) * wx
+    bottom_row = gather(y1, x0) * (1 - wx) + gather(y1, x1) * wx
+    return top_row * (1 - wy) + bottom_row * wy
+
+
+def augment_image_pyramid(images, image_sizes, rng, min_scale=0.64, flip=True):
+    """Random resized crop and horizontal flip of a batch, resampled straight into every resolution of the cascade.
+
+    Replaces make_image_pyramid during training. Each image gets one crop and flip shared by all its
+    resolutions, so the low resolution conditioning of a super resolution unet shows the same crop as its
+    target. Returns float32 batches in the value range of images.
+    """
+    images = np.asarray(images, dtype=np.float32)
+    b, h, w, _ = images.shape
+    top, left, side = random_crop_boxes(rng, b, h, w, min_scale)
+    flips = rng.uniform(size=b) < 0.5 if flip else None
+    levels = [images]
+    # box reductions are shared by every resolution, only as many as the smallest one needs
+    while min(levels[-1].shape[1:3]) // 2 >= min(image_sizes):
+        levels.append(_box_reduce(levels[-1]))
+    return tuple(crop_resize(levels, top, left, side, size, flips) for size in image_sizes)
+
+
 def get_mnist():
     #sklearn seed
     """Load MNIST train and test datasets into memory."""
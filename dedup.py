@@ -0,0 +1,115 @@
+import hashlib
+
+import numpy as np
+import PIL.Image
+
+
+class BloomFilter:
+    """Set membership for millions of keys (urls, file ids) in a fixed bit array.
+
+    `in` never misses a key that was added, and wrongly reports a new key as seen with probability
+    `error_rate` once `capacity` keys were added.
+    """
+
+    def __init__(self, capacity=10_000_000, error_rate=1e-4):
+        self.num_bits = int(np.ceil(-capacity * np.log(error_rate) / np.log(2) ** 2))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * np.log(2))))
+        self.bits = np.zeros((self.num_bits + 7) // 8, dtype=np.uint8)
+        self.count = 0
+
+    def _positions(self, key):
+        # double hashing, k positions from the two halves of one digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key):
+        for p in self._positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+
+def image_hash(image, hash_size=8):
+    """64 bit difference hash of a pillow image or uint8 array: whether each pixel of a (8, 9) grayscale
+    thumbnail is brighter than its right neighbour. Survives rescaling, recompression and small color changes."""
+    if isinstance(image, np.ndarray):
+        image = PIL.Image.fromarray(image)
+    thumbnail = np.asarray(image.convert("L").resize((hash_size + 1, hash_size), PIL.Image.BILINEAR, reducing_gap=2.0), dtype=np.int16)
+    bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class PerceptualHashIndex:
+    """Finds images whose 64 bit hash is within `max_distance` bits of one that was added before.
+
+    Hashes are split into max_distance + 1 chunks, two hashes that differ in at most max_distance bits
+    agree exactly on at least one chunk. Each chunk is a dict lookup, so only the few hashes sharing a
+    chunk are compared bit by bit, however many images were added.
+    """
+
+    def __init__(self, max_distance=4, hash_bits=64):
+        self.max_distance = max_distance
+        num_chunks = max_distance + 1
+        bounds = np.linspace(0, hash_bits, num_chunks + 1).astype(int)
+        self.chunks = [(int(start), (1 << int(stop - start)) - 1) for start, stop in zip(bounds[:-1], bounds[1:])]
+        self.tables = [{} for _ in self.chunks]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _keys(self, image_hash):
+        return [(image_hash >> shift) & mask for shift, mask in self.chunks]
+
+    def contains(self, image_hash):
+        for table, key in zip(self.tables, self._keys(image_hash)):
+            for other in table.get(key, ()):
+                if bin(image_hash ^ other).count("1") <= self.max_distance:
+                    return True
+        return False
+
+    def add(self, image_hash):
+        for table, key in zip(self.tables, self._keys(image_hash)):
+            table.setdefault(key, []).append(image_hash)
+        self.count += 1
+
+    def add_new(self, image_hashes):
+        # adds the hashes that are not near duplicates of earlier ones (including earlier ones in this
+        # batch) and returns which were new
+        new = []
+        for image_hash in image_hashes:
+            is_new = not self.contains(image_hash)
+            if is_new:
+                self.add(image_hash)
+            new.append(is_new)
+        return new
+
+
+def test():
+    rng = np.random.default_rng(0)
+    bloom = BloomFilter(capacity=10_000, error_rate=1e-3)
+    for i in range(10_000):
+        bloom.add(f"https://example.com/{i}.jpg")
+    assert all(f"https://example.com/{i}.jpg" in bloom for i in range(10_000))
+    false_positives = sum(f"https://example.org/{i}.jpg" in bloom for i in range(10_000))
+    print(f"Bloom filter: {bloom.bits.nbytes} bytes, {false_positives / 10_000:.4f} false positive rate")
+
+    image = (np.linspace(0, 255, 256)[None, :, None] * rng.uniform(0.2, 1.0, (256, 1, 3))).astype(np.uint8)
+    image[64:128, 64:128] = 255 - image[64:128, 64:128]
+    resized = np.asarray(PIL.Image.fromarray(image).resize((128, 128)))
+    other = rng.integers(0, 255, (256, 256, 3), dtype=np.uint8)
+    index = PerceptualHashIndex()
+    assert index.add_new([image_hash(image), image_hash(resized), image_hash(other)]) == [True, False, True]
+    assert len(index) == 2
+    print("Perceptual hash index ok")
+
+
+if __name__ == "__main__":
+    test()
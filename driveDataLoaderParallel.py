@@ -1,4 +1,5 @@
 import logging
+import re
 import time
 import ray
 import pyarrow.parquet as pq
@@ -21,11 +22,24 @@ import PIL.Image
 import io
 import datetime
 from datasets import load_dataset
+from image_fetcher import FetchCursor, ImageFetcher, LeaseTable
+from dedup import BloomFilter, PerceptualHashIndex, image_hash
+from metrics import StageMetrics, get_aggregator
+from image_processing import encode_image
+from shards import SHARD_SUFFIX, ShardWriter
+from storage import DriveStorage
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 USER_AGENT = get_datasets_user_agent()
 USE_SAFETY_CHECKER = False
 
-UPLOAD_BUFFER = 10_000
+SHARD_BYTES = 256 * 1024 * 1024  # a shard is uploaded and the next one started once it reaches this size
+# where finished shards go, partial(storage.LocalStorage, "laion_art_shards") keeps them on local disk instead
+STORAGE = partial(DriveStorage, shared_drive_name="LAION-ART")
+FETCH_CONCURRENCY = 256  # downloads in flight per DataCollector
+LEASE_SIZE = 4096  # urls handed to a DataCollector per call
+LEASE_TIMEOUT = 600  # seconds without progress before a lease is handed to another DataCollector
 
 
 SCOPES = ['https://www.googleapis.com/auth/drive']
@@ -54,59 +68,6 @@ def login():
     return creds
 
 
-def upload_pickle_to_google_drive(data, pickle_file_name, creds=None, upload_data_without_file=False):
-    # Set the credentials object with the required scope for accessing Google Drive
-    if creds is None:
-        creds = Credentials.from_authorized_user_file(
-            'token.json',
-            scopes=["https://www.googleapis.com/auth/drive"]
-        )
-
-    # Build the service for interacting with Google Drive
-    service = build("drive", "v3", credentials=creds)
-
-
-    # Obtain the ID of the shared drive
-    # Replace "SHARED_DRIVE_NAME" with the name of the shared drive
-    query = "name='LAION-ART'"
-    results = service.files().list(
-        q=query, 
-        fields="nextPageToken, files(id, name)", 
-        includeItemsFromAllDrives=True,
-        supportsAllDrives=True,
-        corpora="allDrives").execute()
-    print(results)
-
-    # results2 = service.files().list().execute()
-    # print(results2)
-    shared_drive_id = results["files"][0]["id"]
-
-
-    # Dump the data you want to upload to a pickle file
-    if not upload_data_without_file:
-        with open(pickle_file_name, "wb") as f:
-            pickle.dump(data,f)
-            f.close()
-
-    try:
-        # Upload the pickle file to Google Drive
-        file_metadata = {
-            "name": pickle_file_name,
-            "parents": [shared_drive_id]
-            }
-        media = None
-        if not upload_data_without_file:
-            media = MediaFileUpload(pickle_file_name, resumable=True, mimetype='unknown/pkl')
-        else: 
-            media = MediaIoBaseUpload(io.BytesIO(data), mimetype='unknown/pkl', resumable=True)
-        file = service.files().create(body=file_metadata, media_body=media, fields='id', supportsAllDrives=True).execute()
-        print(f"File uploaded: {file.get('id')}")
-
-    except HttpError as error:
-        print(f"An error occurred while uploading the file: {error}")
-        # Handle the error
-
-
 def fetch_single_image(image_url, timeout=None, retries=0):
     for _ in range(retries + 1):
         try:
@@ -128,138 +89,269 @@ class DatasetFetcher:
         self.dataset = load_dataset("laion/laion-art")["train"]
         self.urls = list(self.dataset["URL"])
         self.texts = list(self.dataset["TEXT"])
-        self.index = starting_index
-        self.ending_index = ending_index
-        
-    def get_data(self):
-        if self.ending_index and self.index >= self.ending_index:
+        # resumes from the first url that was not fetched before the last restart
+        self.cursor = FetchCursor("fetch_cursor.json", starting_index)
+        self.leases = LeaseTable(self.cursor.index, ending_index or len(self.urls), LEASE_SIZE, LEASE_TIMEOUT)
+        # urls of completed leases and perceptual hashes of collected images, duplicates are dropped
+        self.seen_urls = BloomFilter(capacity=len(self.urls))
+        self.image_hashes = PerceptualHashIndex()
+
+    def lease(self):
+        lease = self.leases.lease()
+        if lease is None:
             print("Done")
             return None
-        url = self.urls[self.index]
-        text = self.texts[self.index]
-        self.index += 1
-        if self.index % 1000 == 0:
-            print(f"Index: {self.index}")
-            with open("index.txt", "w") as f:
-                f.write(str(self.index))
-                f.close()
-        return url, text
+        lease_id, start, stop = lease
+        urls = []
+        texts = []
+        lease_urls = set()
+        for url, text in zip(self.urls[start:stop], self.texts[start:stop]):
+            if url not in self.seen_urls and url not in lease_urls:
+                lease_urls.add(url)
+                urls.append(url)
+                texts.append(text)
+        return lease_id, urls, texts
+
+    def renew(self, lease_id):
+        return self.leases.renew(lease_id)
+
+    def complete(self, lease_id):
+        done = self.leases.complete(lease_id)
+        if done is None:
+            return False
+        for url in self.urls[done[0]:done[1]]:
+            self.seen_urls.add(url)
+        checkpoint = self.cursor.index // 1000
+        self.cursor.mark_done(range(*done))
+        if self.cursor.index // 1000 > checkpoint:
+            print(f"Index: {self.cursor.index}")
+            self.cursor.save()
+        return True
+
+    def save_cursor(self):
+        self.cursor.save()
+
+    def keep_new_images(self, hashes):
+        # which images are not near duplicates of one collected before
+        return self.image_hashes.add_new(hashes)
 
 @ray.remote
-class SharedStorage:
-    def __init__(self):
-        self.images = []
-        self.texts = []
+class ShardUploader:
+    """Appends collected images, already jpeg encoded, to an open shard file and uploads it once it reaches
+    shard_bytes. Memory use is bounded by one shard, which lives on local disk. flush() uploads the last,
+    partial shard. Shard indices continue after the highest one found in storage or left on local disk, so a
+    restarted run never reuses a shard name.
 
+    Collectors hand in a lease's images with add_data and call finish_lease once it is fetched. The lease is
+    completed with the DatasetFetcher, which advances the persisted cursor, only after every shard holding
+    its images was uploaded, so a crash never skips urls whose images were not stored. Until then the
+    uploader renews the lease.
+    """
 
-    def get_num_images(self):
-        return len(self.images)
-    
-    def add_data(self, images, texts):
-        self.images.extend(images)
-        self.texts.extend(texts)
+    def __init__(self, make_storage, dataset, run_name, save_name="laion_art", start_index=None, shard_bytes=SHARD_BYTES):
+        self.storage = make_storage()
+        self.dataset = dataset
+        self.run_name = run_name
+        self.save_name = save_name
+        self.index = self.next_index() if start_index is None else start_index
+        self.shard_bytes = shard_bytes
+        # at most one finished shard waits for its upload while the next one is written
+        self.upload_executor = ThreadPoolExecutor(max_workers=1)
+        self.pending_upload = None
+        self.num_images = 0
+        self.num_uploaded = 0
+        self.write_metrics = StageMetrics("shard_write")
+        self.upload_metrics = StageMetrics("upload")
+        self.writer = None
+        self.writer_index = None
+        self.lease_shards = {}  # lease id -> indices of the shards with its images that are not uploaded yet
+        self.finished_leases = set()  # fetched leases waiting for their shards' uploads
+        self.last_renewal = time.time()
 
+    def next_index(self):
+        # shards left on local disk are ones whose upload failed, their names are taken as well
+        pattern = re.compile(re.escape(f"{self.run_name}_{self.save_name}_") + r"(\d+)" + re.escape(SHARD_SUFFIX))
+        names = [file["name"] for file in self.storage.list()] + os.listdir(".")
+        indices = [int(match.group(1)) for match in map(pattern.match, names) if match]
+        return max(indices, default=-1) + 1
 
-    def get_batch(self, batch_size):
-        if len(self.images) < batch_size:
-            return None
-        images = self.images[:batch_size]
-        texts = self.texts[:batch_size]
-        self.images = self.images[batch_size:]
-        self.texts = self.texts[batch_size:]
-        return images, texts
+    def open_shard(self):
+        self.writer = ShardWriter(f"{self.run_name}_{self.save_name}_{self.index}{SHARD_SUFFIX}", image_shape=None)
+        self.writer_index = self.index
+        self.index += 1
+
+    def upload(self, path, num_images, index):
+        with self.upload_metrics.busy(num_images):
+            self.storage.upload(path, os.path.basename(path))
+            os.remove(path)
+        self.upload_metrics.count(items_out=num_images)
+        self.num_uploaded += num_images
+        return index
+
+    def confirm_upload(self, wait):
+        # an upload that failed raises here, its leases are never completed and will be fetched again
+        if self.pending_upload is None or not (wait or self.pending_upload.done()):
+            return
+        index = self.pending_upload.result()
+        self.pending_upload = None
+        for shards in self.lease_shards.values():
+            shards.discard(index)
+        self.complete_leases()
+
+    def complete_leases(self):
+        for lease_id in list(self.finished_leases):
+            if not self.lease_shards.get(lease_id):
+                self.finished_leases.discard(lease_id)
+                self.lease_shards.pop(lease_id, None)
+                self.dataset.complete.remote(lease_id)
+
+    def renew_leases(self):
+        # finished leases can wait for a shard to fill for longer than the lease timeout
+        if time.time() - self.last_renewal < LEASE_TIMEOUT / 3:
+            return
+        self.last_renewal = time.time()
+        for lease_id in self.finished_leases:
+            self.dataset.renew.remote(lease_id)
+
+    def finish_lease(self, lease_id):
+        self.finished_leases.add(lease_id)
+        self.confirm_upload(wait=False)
+        self.complete_leases()
+
+    def add_data(self, images, texts, lease_id):
+        self.confirm_upload(wait=False)
+        self.renew_leases()
+        if len(images) == 0:
+            return
+        with self.write_metrics.busy(len(images)):
+            if self.writer is None:
+                self.open_shard()
+            self.lease_shards.setdefault(lease_id, set()).add(self.writer_index)
+            self.writer.add_batch(images, texts)
+            self.num_images += len(images)
+            if self.writer.nbytes >= self.shard_bytes:
+                self.rotate()
+        self.write_metrics.count(items_out=len(images))
+        # images in the open shard
+        self.write_metrics.set_queue_depth(0 if self.writer is None else len(self.writer))
+
+    def rotate(self):
+        # the next shard is opened by the next add_data
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.confirm_upload(wait=True)
+        self.pending_upload = self.upload_executor.submit(self.upload, self.writer.path, len(self.writer), self.writer_index)
+        self.writer = None
+
+    def flush(self):
+        # uploads the open shard however small, waits until every upload is done and saves the cursor
+        self.rotate()
+        self.confirm_upload(wait=True)
+        self.complete_leases()
+        # calls from one actor run in order, the completions above are applied before the save
+        ray.get(self.dataset.save_cursor.remote())
+
+    def get_stats(self):
+        return self.num_images, self.num_uploaded
 
 @ray.remote
 class DataCollector:
-    def __init__(self, dataset, shared_storage):
+    def __init__(self, dataset, uploader):
         self.dataset = dataset
-        self.shared_storage = shared_storage
+        self.uploader = uploader
         if USE_SAFETY_CHECKER:
             safety_model_id = "CompVis/stable-diffusion-safety-checker"
             self.feature_extractor = AutoFeatureExtractor.from_pretrained(safety_model_id)
             self.safety_checker = StableDiffusionSafetyChecker.from_pretrained(safety_model_id)
+        self.fetch_metrics = StageMetrics("fetch")
+        self.encode_metrics = StageMetrics("jpeg_encode")
 
         
+    def filter_image(self, image):
+        w, h= image.size
+        MIN_IMAGE_SIZE = 256
+        if h < MIN_IMAGE_SIZE or w < MIN_IMAGE_SIZE:
+            return None
+        #if h != w:
+          #  return None
+        if USE_SAFETY_CHECKER:
+            safety_cheker_input = self.feature_extractor(image, return_tensors="pt")
+            image, has_unsafe_concept = self.safety_checker(images=[image], clip_input=safety_cheker_input.pixel_values)
+            if has_unsafe_concept[0]:
+                return None
+        return image
+
     def start(self):
+        # images are center cropped to 256x256 downstream, larger jpegs are decoded at reduced size
+        fetcher = ImageFetcher(num_threads=FETCH_CONCURRENCY, user_agent=USER_AGENT, draft_size=256)
         while True:
-            url, text = ray.get(self.dataset.get_data.remote())
-            image = fetch_single_image(url)
-            if image is None:
-                # print("Image is None")
-                continue
-            w, h= image.size
-            MIN_IMAGE_SIZE = 256
-            if h < MIN_IMAGE_SIZE or w < MIN_IMAGE_SIZE:
-                continue
-            #if h != w:
-              #  continue
-            if USE_SAFETY_CHECKER:
-                safety_cheker_input = self.feature_extractor(image, return_tensors="pt")
-                image, has_unsafe_concept = self.safety_checker(images=[image], clip_input=safety_cheker_input.pixel_values)
-                if has_unsafe_concept[0]:
-                    continue
-            self.shared_storage.add_data.remote([image], [text])
-            while ray.get(self.shared_storage.get_num_images.remote()) > UPLOAD_BUFFER:
-                print("Waiting for upload, too many images")
-                time.sleep(5)
+            with self.fetch_metrics.idle():
+                lease = ray.get(self.dataset.lease.remote())
+            if lease is None:
+                break
+            lease_id, urls, texts = lease
+            items = list(zip(urls, texts))
+            for block_start in range(0, len(items), FETCH_CONCURRENCY):
+                # renewing doubles as a heartbeat, a lease that was handed to another worker is dropped
+                if block_start > 0 and not ray.get(self.dataset.renew.remote(lease_id)):
+                    break
+                block = items[block_start:block_start + FETCH_CONCURRENCY]
+                images = []
+                texts = []
+                with self.fetch_metrics.busy(len(block)):
+                    for (_, text), image in fetcher.fetch_many(block, url=lambda item: item[0]):
+                        if image is not None:
+                            image = self.filter_image(image)
+                        if image is not None:
+                            images.append(image)
+                            texts.append(text)
+                self.fetch_metrics.count(items_out=len(images))
+                with self.encode_metrics.busy(len(images)):
+                    keep = ray.get(self.dataset.keep_new_images.remote([image_hash(image) for image in images]))
+                    images = [encode_image(image) for image, keep_image in zip(images, keep) if keep_image]
+                    texts = [text for text, keep_image in zip(texts, keep) if keep_image]
+                self.encode_metrics.count(items_out=len(images))
+                # encoded here, so the uploader only appends bytes; waiting for it keeps collectors at its pace
+                with self.encode_metrics.idle():
+                    ray.get(self.uploader.add_data.remote(images, texts, lease_id))
+            # completed once its images are uploaded, a lease that was lost to another worker completes as a no-op.
+            # Waited for, so DataManager's final flush sees every finished lease
+            ray.get(self.uploader.finish_lease.remote(lease_id))
             
 @ray.remote
 class DataManager:
-    def __init__(self, num_workers, batch_size):
+    def __init__(self, num_workers, run_name):
         START_INDEX = 607000
-        self.shared_storage = SharedStorage.remote()
-        self.batch_size = batch_size
         self.datasetFetcher = DatasetFetcher.remote("laion/part-00000-5b54c5d5-bbcf-484d-a2ce-0d6f73df1a36-c000.snappy.parquet", START_INDEX)
-        self.workers = [DataCollector.remote(self.datasetFetcher, self.shared_storage) for _ in range(num_workers)]
+        self.uploader = ShardUploader.remote(STORAGE, self.datasetFetcher, run_name)
+        self.workers = [DataCollector.remote(self.datasetFetcher, self.uploader) for _ in range(num_workers)]
         
         
     def start(self):
-        for worker in self.workers:
-            worker.start.remote()
-
-    def get_batch(self):
-        data = None
-        while data is None:
-            data = ray.get(
-                self.shared_storage.get_batch.remote(self.batch_size))
-        return data
-    def get_shared_storage(self):
-        return self.shared_storage
+        # returns once every lease is collected and the last shard is uploaded
+        ray.get([worker.start.remote() for worker in self.workers])
+        ray.get(self.uploader.flush.remote())
 
-@ray.remote
-class Uploader:
-    def __init__(self):
-        self.index = 441
-        self.creds = None
-        self.save_name = "laion_art"
-        with open("uploader.txt", "r") as f:        
-            self.run_name = f.read()
-            print("Uploading as", self.run_name)
-    def save(self, data):
-        print(f"Saving {len(data[0])} images")
-        upload_pickle_to_google_drive(data, f"{self.run_name}_{self.save_name}_{self.index}.pkl", self.creds)
-        print(f"Saved {len(data[0])} images")
-        self.index += 1
-        return 1
+    def get_uploader(self):
+        return self.uploader
 
 def main():    
-    dm = DataManager.remote(10, 32)
-    dm.start.remote()
-    uploader = Uploader.remote()
-    shared_storage = ray.get(dm.get_shared_storage.remote())
-    BATCH_SIZE = 1000
+    with open("uploader.txt", "r") as f:        
+        run_name = f.read()
+        print("Uploading as", run_name)
+    dm = DataManager.remote(10, run_name)
+    uploader = ray.get(dm.get_uploader.remote())
+    done = dm.start.remote()
     start_time = time.time()
-    num_uploaded = 0
-    while True:
-        time.sleep(5)
-        batch = ray.get(shared_storage.get_batch.remote(BATCH_SIZE))
-        if batch:
-            num_uploaded += BATCH_SIZE
-            ray.get(uploader.save.remote(batch))
-        num_images = ray.get(shared_storage.get_num_images.remote())
-        images_per_second = (num_uploaded + num_images) / (time.time() - start_time)
-        time_till_next_upload = (BATCH_SIZE - num_images) / (images_per_second + 1e-6)
-        print(f"Images per second: {images_per_second:.2f}, uploaded: {num_uploaded}, Images: {num_images}, time till next upload: {datetime.timedelta(seconds=round(time_till_next_upload))}")
+    finished = False
+    while not finished:
+        # progress report only, collection and uploads do not wait on it
+        finished = bool(ray.wait([done], timeout=30)[0])
+        num_images, num_uploaded = ray.get(uploader.get_stats.remote())
+        images_per_second = num_images / (time.time() - start_time)
+        print(f"Images per second: {images_per_second:.2f}, uploaded: {num_uploaded}, Images: {num_images}, elapsed: {datetime.timedelta(seconds=round(time.time() - start_time))}")
+        print(ray.get(get_aggregator().format_summary.remote()))
             
         
 if __name__ == "__main__":
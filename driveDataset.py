@@ -1,16 +1,20 @@
 import gc
 import pickle
-import random
-import time
-from googleapiclient import errors
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
 import io
 import cv2
 import numpy as np
 import psutil
 import ray
 import T5Utils
+from ring_buffer import RaggedRingBuffer
+from flow_control import Watermarks
+from metrics import StageMetrics, get_aggregator
+from shards import SHARD_SUFFIX, ShardReader
+from storage import ShardCache, drive_storage
+import functools
+from image_processing import ImagePreprocessor
+from embedding_cache import EmbeddingCache
+from text_embeddings import pad_ragged, to_ragged
 import logging
 import os
 os.environ["TCMALLOC_LARGE_ALLOC_REPORT_THRESHOLD"] = "2000000000000"
@@ -18,86 +22,54 @@ GIGABYTE = 1024 * 1024 * 1024
 ray.init(address='auto', _node_ip_address='34.147.22.32')
 # ray.init(logging_level=logging.ERROR, log_to_driver=False)
 
-creds = Credentials.from_authorized_user_file(
-            'token.json',
-            scopes=["https://www.googleapis.com/auth/drive"]
-        )
-
-# 3. Use the `drive_service.files().list()` method to retrieve a list of files in the specified folder
+DATASET_FOLDER = "1QwRiS6rIfWPrzrVBU9x1Y8S6kHXKZnvN"
+# files are downloaded once per host, later epochs read them from local disk
+CACHE_DIR = "cache/shards"
+CACHE_BYTES = 500 * GIGABYTE
 
 
 def list_files():
-    drive_service = build('drive', 'v3', credentials=creds)
-    files = []
-    try:
-        page_token = None
-        while True:
-            query = "'1QwRiS6rIfWPrzrVBU9x1Y8S6kHXKZnvN' in parents"
-            response = drive_service.files().list(q=f"{query}",
-                                                  fields='nextPageToken, '
-                                                  'files(id, name, mimeType)',
-                                                  includeItemsFromAllDrives=True,
-                                                  supportsAllDrives=True, 
-                                                  corpora="allDrives",
-                                                  pageToken=page_token).execute()
-            for file in response.get('files', []):
-                # Process the file
-                files.append(file)
-                # print(F'Found file: {file.get("name")} ({file.get("id")})')
-                
-            page_token = response.get('nextPageToken', None)
-            if page_token is None:
-                break
-    except errors.HttpError as error:
-        print(F'An error occurred: {error}')
-        files = None
-    return files
+    return drive_storage(DATASET_FOLDER).list()
+
+@functools.lru_cache(maxsize=None)
+def shard_cache():
+    return ShardCache(drive_storage(DATASET_FOLDER), CACHE_DIR, CACHE_BYTES)
 
 def download_pickle(file):
-    with open("test.plk", "rb") as f:
+    with open(shard_cache().get(file), "rb") as f:
         data = pickle.load(f)
-        f.close()
-    time.sleep(random.randint(60, 100))
-    return data
-    drive_service = build('drive', 'v3', credentials=creds)
-    request = drive_service.files().get_media(fileId=file.get('id')).execute()
-    data = pickle.load(io.BytesIO(request))
     return data
 
 
 @ray.remote
 class SharedStorageEncoded:
-    def __init__(self):
-        self.images = []
-        self.texts = []
-        self.texts_encoded = []
-        self.attention_masks = []
+    def __init__(self, capacity=10_000, token_capacity=10_000 * 64):
+        # embeddings are buffered at their true length and only padded when a batch is taken out
+        self.buffer = RaggedRingBuffer(capacity, token_capacity)
+        self.watermarks = Watermarks(lambda: len(self.buffer), high=capacity)
+        self.metrics = StageMetrics("storage.encoded")
 
     def get_size(self):
-        return len(self.images)
-
-    def add_data(self, images, texts, texts_encoded, attention_masks):
-        self.images.extend(images)
-        self.texts.extend(texts)
-        self.texts_encoded.extend(texts_encoded)
-        self.attention_masks.extend(attention_masks)
-
-    def get_batch(self, batch_size):
-        if len(self.images) < batch_size:
-            return None
-        images = self.images[:batch_size]
-        texts = self.texts[:batch_size]
-        texts_encoded = self.texts_encoded[:batch_size]
-        attention_masks = self.attention_masks[:batch_size]
-        self.images = self.images[batch_size:]
-        self.texts = self.texts[batch_size:]
-        self.texts_encoded = self.texts_encoded[batch_size:]
-        self.attention_masks = self.attention_masks[batch_size:]
-        images = np.array(self.images)
-        texts = np.array(self.texts)
-        texts_encoded = np.array(self.texts_encoded)
-        attention_masks = np.array(self.attention_masks)
-        return images, texts, texts_encoded, attention_masks
+        return len(self.buffer)
+
+    async def add_data(self, images, texts, embedding_values, embedding_lengths):
+        await self.watermarks.wait_for_space()
+        self.buffer.put(embedding_values, embedding_lengths, images=images, texts=texts)
+        await self.watermarks.changed()
+        self.metrics.count(items_in=len(texts))
+        self.metrics.set_queue_depth(len(self.buffer))
+
+    async def get_batch(self, batch_size):
+        # (images, texts, texts_encoded, attention_masks), called by the trainer itself: the numpy arrays go
+        # into the object store with the return value and the trainer's ray.get maps them as zero-copy views.
+        # Captions are a plain list, they are pickled either way
+        await self.watermarks.wait_for(batch_size)
+        batch = self.buffer.get(batch_size)
+        await self.watermarks.changed()
+        self.metrics.count(items_out=batch_size)
+        self.metrics.set_queue_depth(len(self.buffer))
+        texts_encoded, attention_masks = pad_ragged(batch["values"], batch["lengths"])
+        return batch["images"], batch["texts"].tolist(), texts_encoded, attention_masks
 
 @ray.remote
 class DatasetFetcher:
@@ -110,34 +82,33 @@ class DatasetFetcher:
             self.files = list_files()
         return self.files[self.index % len(self.files)]
 
-def processImage(img):
-    # image is a pillow image
-    height_diff = img.size[1] - img.size[0]
-    width_diff = img.size[0] - img.size[1]
-    height_diff = height_diff // 2
-    width_diff = width_diff // 2
-    width_diff = width_diff if width_diff > 0 else 0
-    height_diff = height_diff if height_diff > 0 else 0
-    img = img.crop((width_diff, height_diff, min(img.size[0], img.size[1]) + width_diff, min(img.size[0], img.size[1]) + height_diff))
-    img = img.resize((256, 256))
-    np_img = np.array(img, dtype=np.uint8)
-    if len(np_img.shape) == 2:
-        np_img = cv2.cvtColor(np_img, cv2.COLOR_GRAY2RGB)
-    if np_img.shape[2] == 4:
-        np_img = cv2.cvtColor(np_img, cv2.COLOR_RGBA2RGB)
-    if np_img.shape[2] == 1:
-        np_img = cv2.cvtColor(np_img, cv2.COLOR_GRAY2RGB)
-    return np_img
+# center crops to 256x256, shared by the collect tasks that run in the same worker process
+preprocessor = ImagePreprocessor(size=256)
+download_metrics = StageMetrics("download")
+preprocess_metrics = StageMetrics("preprocess")
 
 @ray.remote
 def collect(dataset:DatasetFetcher):
     file = ray.get(dataset.get_data.remote())
-    data = download_pickle(file)
-    images = data[0] # list of pil images
-    texts = data[1]
-    # convert pil images to numpy arrays
-    images = [processImage(image) for image in images]
-    images = np.array(images)
+    with download_metrics.busy(1):
+        if file.get('name').endswith(SHARD_SUFFIX):
+            shard = ShardReader(shard_cache().get(file))
+            texts = shard.captions()
+            if not shard.encoded_images:
+                # processed shards already hold 256x256 center crops
+                download_metrics.count(items_out=len(texts))
+                return np.asarray(shard.images), texts
+            # collected shards hold uncropped jpegs, draft decoded to about 256px on the short side and re-encoded
+            images = shard.images_bytes()
+        else:
+            data = download_pickle(file)
+            images = data[0] # list of pil images
+            texts = data[1]
+    download_metrics.count(items_out=len(texts))
+    # pil images or jpeg bytes to a (n, 256, 256, 3) uint8 batch
+    with preprocess_metrics.busy(len(texts)):
+        images = preprocessor(images)
+    preprocess_metrics.count(items_out=len(texts))
     return images, texts
     
 
@@ -146,33 +117,27 @@ class Encoder:
     def __init__(self, shared_storage_encoded, dataset:DatasetFetcher):
         self.shared_storage_encoded = shared_storage_encoded
         self.dataset = dataset
-        self.tokenizer, self.model = T5Utils.get_tokenizer_and_model()
+        self.text_encoder = T5Utils.TextEncoder()
+        self.embedding_cache = EmbeddingCache(T5Utils.name, "cache/embeddings")
         self.batch_size = 1000
-            
+        self.metrics = StageMetrics("t5_encode")
+
     def process(self, data):
         images, texts = data
-        input_ids, attention_mask = T5Utils.tokenize_texts(texts, self.tokenizer)
-        input_ids = np.array(input_ids).reshape(8, -1, 512)
-        attention_mask = np.array(attention_mask).reshape(8, -1, 512)
-        texts_encoded, attention_mask = T5Utils.encode_texts(input_ids, attention_mask, self.model)
-        texts_encoded = np.array(texts_encoded)
-        texts_encoded = texts_encoded.reshape(-1, 512, 1024)
-        attention_mask = np.array(attention_mask)
-        attention_mask.reshape(-1, 512)
-        texts = [text for text in texts]
-        texts_encoded = [text_encoded for text_encoded in texts_encoded]
-        attention_mask = [mask for mask in attention_mask]
-        self.shared_storage_encoded.add_data.remote(images, texts, texts_encoded, attention_mask)
+        with self.metrics.busy(len(texts)):
+            embedding_values, embedding_lengths = to_ragged(self.embedding_cache.lookup(texts, self.text_encoder.encode))
+        self.metrics.count(items_out=len(texts))
+        # blocks while the storage is above its high watermark
+        with self.metrics.idle():
+            ray.get(self.shared_storage_encoded.add_data.remote(images, texts, embedding_values, embedding_lengths))
         
     
     def encode(self):
         batches = [collect.remote(self.dataset) for _ in range(60)]
         while True:
-            if ray.get(self.shared_storage_encoded.get_size.remote()) > 10000:
-                time.sleep(1)
-                continue
-            batch, batches = ray.wait(batches, num_returns=1)
-            batch = ray.get(batch)[0]
+            with self.metrics.idle():
+                batch, batches = ray.wait(batches, num_returns=1)
+                batch = ray.get(batch)[0]
             self.process(batch)
             batches.append(collect.remote(self.dataset))
             
@@ -190,27 +155,30 @@ class DataManager:
     def get_num_images(self):
         return ray.get(self.shared_storage_encoded.get_size.remote())
     
-    def get_batch(self):
-        while True:
-            data = ray.get(self.shared_storage_encoded.get_batch.remote(self.batch_size))
-            if data is None:
-                time.sleep(1)
-                continue
-            else:
-                return data
+    def get_storage(self):
+        # batches are taken straight from the storage, so they never pass through (and are never copied by) the manager
+        return self.shared_storage_encoded
+
+
+def get_batch(storage, batch_size, metrics):
+    # one ray.get, blocks in the storage until a full batch is buffered; metrics measure how long the trainer waits
+    with metrics.idle():
+        batch = ray.get(storage.get_batch.remote(batch_size))
+    metrics.count(items_out=batch_size)
+    return batch
+
 
 def test():
-    datamanager = DataManager.remote(1024)
+    batch_size = 1024
+    datamanager = DataManager.remote(batch_size)
+    storage = ray.get(datamanager.get_storage.remote())
+    metrics = StageMetrics("consume")
     total_processed = 0
     while True:
-        time.sleep(1)
-        print("Current Storage", ray.get(datamanager.get_num_images.remote()))
-        batch = ray.get(ray.get(datamanager.get_batch.remote()))
-        if batch is None:
-            continue
-        else:
-            images, texts, texts_encoded, attention_mask = batch
-            total_processed += len(images)
-            print("Total Processed", total_processed)
+        images, texts, texts_encoded, attention_mask = get_batch(storage, batch_size, metrics)
+        total_processed += len(images)
+        print("Total Processed", total_processed, "Current Storage", ray.get(datamanager.get_num_images.remote()))
+        if total_processed % (100 * len(images)) == 0:
+            print(ray.get(get_aggregator().format_summary.remote()))
 if __name__ == "__main__":
     test()
@@ -0,0 +1,90 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import jax.numpy as jnp
+
+from text_embeddings import pad_embeddings
+
+
+def normalize_caption(caption):
+    # T5 is case sensitive, so only whitespace is normalized
+    return " ".join(caption.split())
+
+
+class EmbeddingCache:
+    """Content-addressed store of text embeddings, keyed by the encoder name and the normalized caption.
+
+    Embeddings are kept in bf16 at their true token length. Recently used ones live in an in-memory LRU,
+    everything that was ever encoded is also written to `directory` (if given) so other workers and later
+    runs only pay for a file read.
+    """
+
+    def __init__(self, encoder_name, directory=None, max_items=100_000):
+        self.encoder_name = encoder_name
+        self.directory = directory
+        self.max_items = max_items
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, caption):
+        return hashlib.sha1(f"{self.encoder_name}\0{normalize_caption(caption)}".encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".npy")
+
+    def _remember(self, key, embedding):
+        self.memory[key] = embedding
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def get(self, caption):
+        key = self.key(caption)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.directory is not None and os.path.exists(self._path(key)):
+            # numpy can not describe bf16 in .npy files, the raw bits are stored as uint16
+            embedding = np.load(self._path(key)).view(jnp.bfloat16)
+            self._remember(key, embedding)
+            return embedding
+        return None
+
+    def put(self, caption, embedding):
+        key = self.key(caption)
+        embedding = np.asarray(embedding).astype(jnp.bfloat16)
+        self._remember(key, embedding)
+        if self.directory is not None:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + f".{os.getpid()}.tmp", "wb") as f:
+                np.save(f, embedding.view(np.uint16))
+            os.replace(path + f".{os.getpid()}.tmp", path)
+        return embedding
+
+    def lookup(self, texts, encode_fn):
+        """Embeddings of `texts` at their true length, only captions missing from the cache are encoded.
+
+        encode_fn maps a list of captions to a list of unpadded embeddings (e.g. T5Utils.TextEncoder.encode),
+        or to padded (embeddings, attention_mask) arrays.
+        """
+        embeddings = [self.get(text) for text in texts]
+        missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            encoded = encode_fn(missing)
+            if isinstance(encoded, tuple):
+                encoded, attention_mask = encoded
+                encoded = [embedding[:length] for embedding, length in zip(np.asarray(encoded), np.asarray(attention_mask).sum(axis=-1))]
+            encoded = {text: self.put(text, embedding) for text, embedding in zip(missing, encoded)}
+            embeddings = [encoded[text] if embedding is None else embedding for text, embedding in zip(texts, embeddings)]
+        return embeddings
+
+    def encode(self, texts, encode_fn, pad_to=None):
+        # drop-in for encode_fn: padded (b, pad_to, dim) embeddings and the matching attention mask,
+        # by default padded to the length bucket of the longest caption
+        return pad_embeddings(self.lookup(texts, encode_fn), pad_to)
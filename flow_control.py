@@ -0,0 +1,114 @@
+import asyncio
+
+
+class Watermarks:
+    """Blocking flow control for a buffer owned by an async Ray actor.
+
+    Producers await wait_for_space() before adding: once the buffer reaches `high` they are paused until
+    consumers drain it down to `low`, so producers resume in bulk instead of one slot at a time. Consumers
+    await wait_for(n) until n examples are buffered, a consumer waiting for more than are buffered resumes
+    paused producers early (otherwise a request between low and high would wait forever). Every put/get
+    must be followed by changed(), which wakes the waiters immediately, nobody polls or sleeps.
+    """
+
+    def __init__(self, size_fn, high, low=None):
+        self.size_fn = size_fn
+        self.high = high
+        self.low = high // 2 if low is None else low
+        self.paused = False
+        self._condition = None
+
+    @property
+    def condition(self):
+        # created lazily, so it belongs to the event loop of the actor rather than the one running __init__
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def _update(self):
+        size = self.size_fn()
+        if size >= self.high:
+            self.paused = True
+        elif size <= self.low:
+            self.paused = False
+
+    async def wait_for_space(self):
+        async with self.condition:
+            self._update()
+            await self.condition.wait_for(lambda: not self.paused)
+
+    async def wait_for(self, n):
+        assert n <= self.high, "producers pause at the high watermark, so more could never be buffered"
+        def ready():
+            if self.size_fn() >= n:
+                return True
+            if self.paused:
+                # the buffer will not drain to low while this consumer waits, so producers resume now
+                self.paused = False
+                self.condition.notify_all()
+            return False
+
+        async with self.condition:
+            await self.condition.wait_for(ready)
+
+    async def changed(self):
+        async with self.condition:
+            self._update()
+            self.condition.notify_all()
+
+
+def test():
+    buffer = []
+    watermarks = Watermarks(lambda: len(buffer), high=4, low=1)
+    produced = []
+
+    async def producer():
+        for i in range(10):
+            await watermarks.wait_for_space()
+            buffer.append(i)
+            produced.append(len(buffer))
+            await watermarks.changed()
+
+    async def consumer():
+        consumed = []
+        while len(consumed) < 10:
+            await watermarks.wait_for(2)
+            consumed.extend(buffer[:2])
+            del buffer[:2]
+            await watermarks.changed()
+        return consumed
+
+    async def main():
+        _, consumed = await asyncio.gather(producer(), consumer())
+        assert consumed == list(range(10)), consumed
+        assert max(produced) <= watermarks.high, produced
+
+    asyncio.run(main())
+
+    # a consumer asking for more than low must not deadlock against paused producers
+    buffer.clear()
+    produced.clear()
+
+    async def large_consumer():
+        consumed = []
+        while len(consumed) < 10:
+            # alternates 2 and 3: after taking 2 of 4 the buffer is above low but below the next request
+            n = 2 if len(consumed) % 5 == 0 else 3
+            await watermarks.wait_for(n)
+            consumed.extend(buffer[:n])
+            del buffer[:n]
+            await watermarks.changed()
+        return consumed
+
+    async def main_large():
+        _, consumed = await asyncio.wait_for(asyncio.gather(producer(), large_consumer()), timeout=5)
+        assert consumed == list(range(10)), consumed
+        assert max(produced) <= watermarks.high, produced
+
+    watermarks = Watermarks(lambda: len(buffer), high=4, low=1)
+    asyncio.run(main_large())
+    print("Watermarks ok")
+
+
+if __name__ == "__main__":
+    test()
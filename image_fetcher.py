@@ -0,0 +1,183 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import PIL.Image
+import urllib3
+from urllib3.util.retry import Retry
+
+from image_processing import decode_image
+
+
+class ImageFetcher:
+    """Downloads many images concurrently over pooled, kept-alive connections.
+
+    A single urllib3 PoolManager keeps up to `connections_per_host` open connections to every host, so
+    consecutive images from the same CDN reuse them. It defaults to num_threads: every thread may be talking
+    to the same host, and connections beyond the pool size would be closed after each request instead of
+    reused. Transient failures (connection errors, 429 and 5xx) are
+    retried with exponential backoff, every request is bounded by `timeout`.
+    """
+
+    def __init__(self, num_threads=256, timeout=10.0, retries=3, backoff_factor=0.5, connections_per_host=None, user_agent=None, draft_size=None):
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+        headers = {"user-agent": user_agent} if user_agent else None
+        self.http = urllib3.PoolManager(
+            num_pools=1024,
+            maxsize=connections_per_host or num_threads,
+            retries=retry,
+            timeout=urllib3.Timeout(connect=timeout, read=timeout),
+            headers=headers,
+        )
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        # jpegs are decoded at reduced size when that still covers draft_size x draft_size
+        self.draft_size = draft_size
+
+    def fetch(self, url):
+        try:
+            response = self.http.request("GET", url, preload_content=True)
+            if response.status != 200:
+                return None
+            return decode_image(response.data, self.draft_size)
+        except Exception:
+            return None
+
+    def fetch_many(self, items, url=lambda item: item):
+        # yields (item, image or None) as downloads finish, not in the order of items
+        futures = {self.executor.submit(self.fetch, url(item)): item for item in items}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.http.clear()
+
+
+class FetchCursor:
+    """Checkpointed position in a list of urls that survives restarts.
+
+    Items can finish out of order, the saved index is the first one that is not done yet, so a restarted
+    fetcher neither skips unfinished items nor (apart from the out of order tail) repeats finished ones.
+    """
+
+    def __init__(self, path, start=0):
+        self.path = path
+        self.index = start
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.index = json.load(f)["index"]
+        self.done = set()
+
+    def mark_done(self, indices):
+        self.done.update(index for index in indices if index >= self.index)
+        while self.index in self.done:
+            self.done.remove(self.index)
+            self.index += 1
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"index": self.index}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class LeaseTable:
+    """Hands out contiguous [start, stop) index ranges to workers, one call per range instead of per index.
+
+    A lease that is not renewed or completed within `timeout` seconds is assumed to belong to a crashed
+    worker and its range is handed out again. Renewing or completing a lease that was re-issued fails, so
+    the original worker knows to drop it.
+    """
+
+    def __init__(self, start, end, lease_size=1024, timeout=600.0):
+        self.next_index = start
+        self.end = end
+        self.lease_size = lease_size
+        self.timeout = timeout
+        self.leases = {}  # lease id -> (start, stop, deadline)
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.leases)
+
+    def _issue(self, start, stop, now):
+        lease_id = self.next_id
+        self.next_id += 1
+        self.leases[lease_id] = (start, stop, now + self.timeout)
+        return lease_id, start, stop
+
+    def lease(self, now=None):
+        # (lease id, start, stop), or None once every index was handed out and no lease expired
+        now = time.time() if now is None else now
+        for lease_id, (start, stop, deadline) in list(self.leases.items()):
+            if deadline < now:
+                del self.leases[lease_id]
+                return self._issue(start, stop, now)
+        if self.next_index >= self.end:
+            return None
+        start = self.next_index
+        self.next_index = min(start + self.lease_size, self.end)
+        return self._issue(start, self.next_index, now)
+
+    def renew(self, lease_id, now=None):
+        if lease_id not in self.leases:
+            return False
+        start, stop, _ = self.leases[lease_id]
+        self.leases[lease_id] = (start, stop, (time.time() if now is None else now) + self.timeout)
+        return True
+
+    def complete(self, lease_id):
+        # the (start, stop) range of the lease, None if it expired and was re-issued
+        if lease_id not in self.leases:
+            return None
+        start, stop, _ = self.leases.pop(lease_id)
+        return start, stop
+
+
+def test(num_images=1000):
+    # fetches from a local http server, to measure the fetcher without depending on the network
+    import functools
+    import tempfile
+    import threading
+    import time
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+    directory = tempfile.mkdtemp()
+    PIL.Image.new("RGB", (256, 256), color=(255, 0, 0)).save(os.path.join(directory, "image.jpg"))
+    handler = functools.partial(SimpleHTTPRequestHandler, directory=directory)
+    handler.protocol_version = "HTTP/1.1"  # keep-alive, so connection reuse is exercised
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+
+    fetcher = ImageFetcher(num_threads=64, timeout=5.0)
+    urls = [f"http://{host}:{port}/image.jpg?{i}" for i in range(num_images)] + [f"http://{host}:{port}/missing.jpg"]
+    start_time = time.time()
+    results = dict(fetcher.fetch_many(urls))
+    elapsed = time.time() - start_time
+    assert all(results[url] is not None for url in urls[:-1]) and results[urls[-1]] is None
+    print(f"Fetched {num_images} images in {elapsed:0.2f}s ({num_images / elapsed:0.0f} images/sec)")
+
+    cursor = FetchCursor(os.path.join(directory, "cursor.json"))
+    cursor.mark_done([1, 2])
+    assert cursor.index == 0
+    cursor.mark_done([0])
+    assert cursor.index == 3
+    cursor.save()
+    assert FetchCursor(cursor.path).index == 3
+
+    leases = LeaseTable(0, 2500, lease_size=1000, timeout=10)
+    assert leases.lease(now=0) == (0, 0, 1000)
+    assert leases.lease(now=0) == (1, 1000, 2000)
+    assert leases.renew(1, now=5)
+    assert leases.complete(1) == (1000, 2000)
+    assert leases.lease(now=11) == (2, 0, 1000)  # lease 0 expired, its range is handed out again
+    assert not leases.renew(0) and leases.complete(0) is None
+    assert leases.lease(now=11) == (3, 2000, 2500)
+    assert leases.lease(now=11) is None
+    fetcher.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,107 @@
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import PIL.Image
+
+
+def decode_image(data, size=None):
+    # with a size, jpegs are decoded at the smallest DCT scale (1/2, 1/4 or 1/8) that still covers size x size
+    image = PIL.Image.open(io.BytesIO(data))
+    if size is not None:
+        image.draft("RGB", (size, size))
+    image.load()
+    return image
+
+
+def encode_image(image, quality=95):
+    # compressed jpeg bytes of a pillow image, for shards that keep images uncropped and at variable size
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def center_crop_box(width, height):
+    side = min(width, height)
+    left = (width - side) // 2
+    top = (height - side) // 2
+    return left, top, left + side, top + side
+
+
+def center_crop_resize(image, size, out=None):
+    """Center crop of a pillow image resized to a (size, size, 3) uint8 array, written to out if given.
+
+    The crop is folded into the resize and large images are first reduced by an integer factor, Pillow
+    releases the GIL for both, so several images can be processed in parallel threads.
+    """
+    if image.mode not in ("RGB", "RGBA", "L"):
+        image = image.convert("RGB")
+    image = image.resize((size, size), PIL.Image.BICUBIC, box=center_crop_box(*image.size), reducing_gap=2.0)
+    if image.mode != "RGB":
+        # grayscale is repeated over the channels, alpha is dropped
+        image = image.convert("RGB")
+    if out is None:
+        return np.asarray(image, dtype=np.uint8)
+    out[...] = np.asarray(image, dtype=np.uint8)
+    return out
+
+
+class ImagePreprocessor:
+    """Center crops and resizes batches of pillow images (or encoded image bytes) on a thread pool.
+
+    Every image is written straight into its slot of a preallocated (n, size, size, 3) uint8 batch. The
+    throughput so far is reported in images per second of cpu time, i.e. per core.
+    """
+
+    def __init__(self, size=256, num_threads=None):
+        self.size = size
+        self.executor = ThreadPoolExecutor(max_workers=num_threads or os.cpu_count())
+        self.num_images = 0
+        self.cpu_time = 0.0
+
+    def _process(self, image, out):
+        if isinstance(image, bytes):
+            image = decode_image(image, self.size)
+        center_crop_resize(image, self.size, out)
+
+    def __call__(self, images):
+        batch = np.empty((len(images), self.size, self.size, 3), dtype=np.uint8)
+        start_time = time.process_time()
+        # list() waits for every image and re-raises the first exception
+        list(self.executor.map(self._process, images, batch))
+        self.cpu_time += time.process_time() - start_time
+        self.num_images += len(images)
+        return batch
+
+    @property
+    def images_per_second_per_core(self):
+        return self.num_images / max(self.cpu_time, 1e-6)
+
+
+def test(num_images=512):
+    # synthetic jpegs of mixed shapes and modes, to measure decoding and resizing without the network
+    rng = np.random.default_rng(0)
+    images = []
+    for i in range(num_images):
+        width, height = rng.integers(300, 1200, size=2)
+        image = PIL.Image.fromarray(rng.integers(0, 255, (height, width, 3), dtype=np.uint8))
+        buffer = io.BytesIO()
+        image.convert(["RGB", "L", "CMYK"][i % 3]).save(buffer, format="JPEG")
+        images.append(buffer.getvalue())
+    images.append(PIL.Image.new("RGBA", (400, 300)))
+    images.append(PIL.Image.new("P", (300, 400)))
+
+    preprocessor = ImagePreprocessor(size=256)
+    start_time = time.time()
+    batch = preprocessor(images)
+    elapsed = time.time() - start_time
+    assert batch.shape == (len(images), 256, 256, 3) and batch.dtype == np.uint8
+    print(f"Preprocessed {len(images)} images in {elapsed:0.2f}s, {preprocessor.images_per_second_per_core:0.0f} images/sec/core")
+
+
+if __name__ == "__main__":
+    test()
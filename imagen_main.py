@@ -23,6 +23,7 @@ import numpy as np
 
 from jax.experimental import PartitionSpec as P
 from jax.experimental.pjit import pjit
+from jax.sharding import NamedSharding
 
 import partitioning as nnp
 
@@ -30,6 +31,7 @@ from flax.linen import partitioning as nn_partitioning
 from flax.core.frozen_dict import FrozenDict, freeze, unfreeze
 
 from utils import right_pad_dims_to
+from text_embeddings import bucket_length
 from config import ImagenConfig
 from jax.experimental.maps import Mesh
 from jax.experimental import checkify
@@ -182,11 +184,38 @@ def p_sample_loop(unet_state, img, texts, attention, lowres_cond_image, rng):
     return img
 
 
+def upsample_matrix(in_size, out_size):
+    # (out_size, in_size) bilinear interpolation weights, with pixel centers placed as in jax.image.resize
+    positions = np.clip((np.arange(out_size) + 0.5) * in_size / out_size - 0.5, 0, in_size - 1)
+    lower = np.floor(positions).astype(np.int32)
+    upper = np.minimum(lower + 1, in_size - 1)
+    weights = positions - lower
+    matrix = np.zeros((out_size, in_size), dtype=np.float32)
+    matrix[np.arange(out_size), lower] += 1 - weights
+    matrix[np.arange(out_size), upper] += weights
+    return matrix
+
+
+def upsample(images, size):
+    # bilinear upsampling of a square (b, h, w, c) batch to (b, size, size, c) as a single einsum with constant
+    # matrices, so inside a jitted step it is fused with what follows instead of being a separate resize
+    if images.shape[1] == size:
+        return images
+    matrix = jnp.asarray(upsample_matrix(images.shape[1], size), dtype=images.dtype)
+    return jnp.einsum('hH,bHWc,wW->bhwc', matrix, images, matrix)
+
+
 def sample(unet_state, noise, texts, attention, lowres_cond_image, rng):
+    # lowres_cond_image is the previous unet's output at its own resolution
+    if lowres_cond_image is not None:
+        lowres_cond_image = upsample(lowres_cond_image, noise.shape[1])
     return p_sample_loop(unet_state, noise, texts, attention, lowres_cond_image, rng)
 
 
 def train_step(unet_state, imgs_start, timestep, texts, attention_masks, lowres_cond_image, lowres_aug_times, rng):
+    # lowres_cond_image is the previous unet's target at its own resolution
+    if lowres_cond_image is not None:
+        lowres_cond_image = upsample(lowres_cond_image, imgs_start.shape[1])
     rng, key = jax.random.split(rng)
     noise = jax.random.uniform(key, imgs_start.shape, minval=-1, maxval=1)
     rng, key = jax.random.split(rng)
@@ -229,8 +258,13 @@ class Imagen:
         batch_size = config.batch_size
 
         self.unets = []
+        self.unet_specs = []
+        self.stage_unets = {}
         self.train_steps = []
+        self.compiled_train_steps = {}
         self.sample_steps = []
+        self.sample_resources = []
+        self.stage_sample_steps = {}
         self.schedulers = []
 
         mesh_shape = (2,4)
@@ -323,6 +357,7 @@ class Imagen:
                 )
 
                 self.unets.append(unet_state)
+                self.unet_specs.append(unet_spec)
                 self.schedulers.append(scheduler)
                 p_train_step = pjit(train_step, in_axis_resources=(
                     unet_spec,
@@ -334,18 +369,19 @@ class Imagen:
                     P("dp",) if unet_config.lowres_conditioning else None,  # lowres_image
                     None
                 ), out_axis_resources=(unet_spec, None))
-                p_sample = pjit(sample, in_axis_resources=(
+                sample_resources = (
                     unet_spec,
                     P("dp"),  # image
                     P("dp"),  # text
                     P("dp"),  # masks
                     P("dp") if unet_config.lowres_conditioning else None,  # lowres_image
                     None  # key
-                ), out_axis_resources=(P("dp"),)
                 )
+                p_sample = pjit(sample, in_axis_resources=sample_resources, out_axis_resources=(P("dp"),))
 
                 self.train_steps.append(p_train_step)
                 self.sample_steps.append(p_sample)
+                self.sample_resources.append(sample_resources)
                 n_params_flax = sum(
                     jax.tree_leaves(jax.tree_map(lambda x: np.prod(x.shape), params))
                 )
@@ -353,42 +389,160 @@ class Imagen:
 
         print(f"Imagen setup complete, it took {time.time() - start_time: 0.4f} seconds for a total of {num_total_params:,} parameters")
 
+    def pad_text_to_bucket(self, texts, attention):
+        # pads (or cuts) the text length to its bucket so only len(text_length_buckets) shapes are ever compiled
+        bucket = bucket_length(texts.shape[1], self.config.text_length_buckets)
+        texts, attention = texts[:, :bucket], attention[:, :bucket]
+        padding = bucket - texts.shape[1]
+        if padding > 0:
+            texts = jnp.pad(texts, ((0, 0), (0, padding), (0, 0)))
+            attention = jnp.pad(attention, ((0, 0), (0, padding)))
+        return texts, attention
+
+    def compile_train_steps(self):
+        # ahead of time compilation of every unet's train step for every text length bucket
+        batch_size = self.config.batch_size
+        with maps.Mesh(self.devices, ('dp', 'mp')):
+            for i, unet_config in enumerate(self.config.unets):
+                size = self.config.image_sizes[i]
+                images = jnp.zeros((batch_size, size, size, 3), dtype=jnp.bfloat16)
+                times = jnp.zeros((batch_size,), dtype=jnp.float32)
+                lowres_size = self.config.image_sizes[i - 1] if i > 0 else size
+                lowres_cond_image = jnp.zeros((batch_size, lowres_size, lowres_size, 3), dtype=jnp.bfloat16) if unet_config.lowres_conditioning else None
+                lowres_aug_times = times if unet_config.lowres_conditioning else None
+                for bucket in self.config.text_length_buckets:
+                    texts = jnp.zeros((batch_size, bucket, unet_config.token_embedding_dim), dtype=jnp.bfloat16)
+                    attention = jnp.zeros((batch_size, bucket), dtype=jnp.bfloat16)
+                    self.compiled_train_steps[(i, bucket)] = self.train_steps[i].lower(
+                        self.unets[i], images, times, texts, attention, lowres_cond_image, lowres_aug_times, self.get_key()).compile()
+
     def get_key(self):
         self.random_state, key = jax.random.split(self.random_state)
         return key
 
+    def state_dict(self):
+        # what a checkpoint holds: the train state of every unet and the random state
+        return {"train_states": [unet.train_state for unet in self.unets], "random_state": self.random_state}
+
+    def load_state_dict(self, state):
+        # restored arrays live on the host, they are sharded back onto the mesh like freshly initialized ones
+        with maps.Mesh(self.devices, ('dp', 'mp')):
+            for i, train_state in enumerate(state["train_states"]):
+                unet_state = self.unets[i].replace(train_state=train_state)
+                self.unets[i] = pjit(lambda state: state, in_axis_resources=(None,), out_axis_resources=self.unet_specs[i])(unet_state)
+        self.random_state = state["random_state"]
+        self.stage_unets = {}
+
     def sample(self, texts, attention):
+        texts, attention = self.pad_text_to_bucket(texts, attention)
         with maps.Mesh(self.devices, ('dp', 'mp')):
             lowres_images = None
             for i in range(len(self.unets)):
                 batch_size = texts.shape[0]
-                if self.unets[i].unet_config.lowres_conditioning:
-                    lowres_images = jax.image.resize(lowres_images, (texts.shape[0], self.config.image_sizes[i], self.config.image_sizes[i], lowres_images.shape[-1]), method='nearest')
                 noise = jax.random.uniform(self.get_key(), (batch_size, self.config.image_sizes[i], self.config.image_sizes[i], 3), minval=-1, maxval=1)
                 image = self.sample_steps[i](self.unets[i], noise, texts, attention, lowres_images, self.get_key())
                 lowres_images = image
         return image
 
+    def image_pyramid(self, image_batch):
+        # image_batch is either the pyramid built by the data loader (dataset_utils.make_image_pyramid),
+        # one image batch per entry of config.image_sizes, or a single batch that is resized here once
+        if isinstance(image_batch, (tuple, list)):
+            assert len(image_batch) == len(self.config.image_sizes), "expected one image batch per unet"
+            return [images.astype(jnp.bfloat16) for images in image_batch]
+        image_batch = image_batch.astype(jnp.bfloat16)
+        pyramid = []
+        for size in self.config.image_sizes:
+            shape = (image_batch.shape[0], size, size, image_batch.shape[-1])
+            pyramid.append(image_batch if image_batch.shape == shape else jax.image.resize(image_batch, shape, method='linear', antialias=True))
+        return pyramid
+
+    def stage_meshes(self):
+        # split the data parallel rows of the device mesh between the unets of the cascade
+        num_stages = len(self.unets)
+        # a single stage (or too few rows to split) samples on the full mesh, without copies or extra programs
+        if num_stages == 1 or self.devices.shape[0] < num_stages:
+            return [self.mesh] * num_stages
+        return [maps.Mesh(devices, ('dp', 'mp')) for devices in np.array_split(self.devices, num_stages, axis=0)]
+
+    def stage_unet(self, i, mesh):
+        # copy of the unet state placed on the devices of its pipeline stage, refreshed whenever it has trained.
+        # Every train step or restore replaces self.unets[i], so comparing identities needs no sync with the devices
+        if mesh is self.mesh:
+            return self.unets[i]
+        if i not in self.stage_unets or self.stage_unets[i][0] is not self.unets[i]:
+            # device to device copy with the unet's partition specs on the stage mesh, a None spec is replicated
+            specs, treedef = jax.tree_util.tree_flatten(self.unet_specs[i], is_leaf=lambda spec: spec is None or isinstance(spec, P))
+            subtrees = treedef.flatten_up_to(self.unets[i])
+            placed = [jax.device_put(subtree, NamedSharding(mesh, P() if spec is None else spec)) for spec, subtree in zip(specs, subtrees)]
+            self.stage_unets[i] = (self.unets[i], treedef.unflatten(placed))
+        return self.stage_unets[i][1]
+
+    def stage_sample_step(self, i, mesh):
+        # one pjit per pipeline stage, so each keeps the program compiled for its own mesh
+        if mesh is self.mesh:
+            return self.sample_steps[i]
+        if i not in self.stage_sample_steps:
+            self.stage_sample_steps[i] = pjit(sample, in_axis_resources=self.sample_resources[i], out_axis_resources=(P("dp"),))
+        return self.stage_sample_steps[i]
+
+    def sample_pipelined(self, texts, attention, microbatch_size):
+        # each unet samples on its own group of devices; microbatch k is super-resolved while the
+        # base unet is already sampling microbatch k + 1
+        texts, attention = self.pad_text_to_bucket(texts, attention)
+        meshes = self.stage_meshes()
+        assert texts.shape[0] % microbatch_size == 0, f"batch of {texts.shape[0]} is not divisible into microbatches of {microbatch_size}"
+        for mesh in meshes:
+            dp = mesh.devices.shape[0]
+            assert microbatch_size % dp == 0, f"microbatch_size {microbatch_size} is not divisible by the {dp} data parallel devices of a stage"
+        unets = [self.stage_unet(i, mesh) for i, mesh in enumerate(meshes)]
+        sample_steps = [self.stage_sample_step(i, mesh) for i, mesh in enumerate(meshes)]
+        microbatches = [(texts[k:k + microbatch_size], attention[k:k + microbatch_size]) for k in range(0, texts.shape[0], microbatch_size)]
+        num_stages = len(self.unets)
+        outputs = [[None] * len(microbatches) for _ in range(num_stages)]
+        for tick in range(len(microbatches) + num_stages - 1):
+            # sampling is dispatched asynchronously, so every stage of a tick runs concurrently
+            for i in range(num_stages):
+                k = tick - i
+                if not 0 <= k < len(microbatches):
+                    continue
+                texts_microbatch, attention_microbatch = microbatches[k]
+                shape = (texts_microbatch.shape[0], self.config.image_sizes[i], self.config.image_sizes[i], 3)
+                with meshes[i]:
+                    lowres_images = None
+                    if self.unets[i].unet_config.lowres_conditioning:
+                        # hand the previous stage's output over to this stage's devices, without waiting for it on the host
+                        lowres_images = jax.device_put(outputs[i - 1][k], NamedSharding(meshes[i], P("dp")))
+                        outputs[i - 1][k] = None
+                    noise = jax.random.uniform(self.get_key(), shape, minval=-1, maxval=1)
+                    outputs[i][k] = sample_steps[i](unets[i], noise, texts_microbatch, attention_microbatch, lowres_images, self.get_key())
+        return np.concatenate([np.asarray(images) for images in outputs[-1]], axis=0)
+
     def train_step(self, image_batch, texts_batches=None, attention_batches=None):
         with maps.Mesh(self.devices, ('dp', 'mp')):
-            image_batch = image_batch.astype(jnp.bfloat16)
+            image_pyramid = self.image_pyramid(image_batch)
+            texts_batches, attention_batches = self.pad_text_to_bucket(texts_batches, attention_batches)
             texts_batches = texts_batches.astype(jnp.bfloat16)
             attention_batches = attention_batches.astype(jnp.bfloat16)
+            bucket = texts_batches.shape[1]
 
             key = self.get_key()
             metrics = {}
             for i in range(len(self.unets)):
-                # resize image batch to the size of the current unet
+                image_batch = image_pyramid[i]
                 lowres_cond_image = None
                 lowres_aug_times = None
                 timestep = self.schedulers[i].sample_random_timestep(image_batch.shape[0], key)
                 if self.config.unets[i].lowres_conditioning:
-                    lowres_cond_image = jax.image.resize(image_batch, (image_batch.shape[0], self.config.image_sizes[i], self.config.image_sizes[i], 3), method='nearest')
+                    # condition on the previous stage's target, the train step upsamples it to the size of the current unet
+                    lowres_cond_image = image_pyramid[i - 1] if i > 0 else image_batch
                     lowres_aug_times = self.schedulers[i].sample_random_timestep(1, key)
                     lowres_aug_times = repeat(lowres_aug_times, '1 -> b', b=image_batch.shape[0])
 
-                image_batch = jax.image.resize(image_batch, (image_batch.shape[0], self.config.image_sizes[i], self.config.image_sizes[i], 3), method='nearest')
-                self.unets[i], unet_metrics = self.train_steps[i](
+                # batches of other sizes fall back to the jit compiled train step
+                precompiled = image_batch.shape[0] == self.config.batch_size and (i, bucket) in self.compiled_train_steps
+                train_step = self.compiled_train_steps[(i, bucket)] if precompiled else self.train_steps[i]
+                self.unets[i], unet_metrics = train_step(
                     self.unets[i],
                     image_batch,
                     timestep,
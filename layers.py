@@ -5,7 +5,7 @@ import jax
 import flax
 from flax import linen as nn
 import jax.numpy as jnp
-from numpy import block
+import numpy as np
 
 from tqdm import tqdm
 
@@ -61,45 +61,54 @@ class Attention(nn.Module):
 
         scale = self.config.dim_heads ** -0.5 # TODO: Implement cosine sim attention
         inner_dim = self.config.dim_heads * self.block_config.num_heads
+        kv_heads = self.block_config.num_kv_heads
         x = LayerNorm()(x)
         x = with_sharding_constraint(x, ("batch", "length", "mlp"))
 
         q = nn.Dense(features=inner_dim, use_bias=False, dtype=self.config.dtype)(x)
-        k, v = nn.Dense(features=self.config.dim_heads * 2, use_bias=False, dtype=self.config.dtype)(x).split(2, axis=-1)  # TODO: Check if it should be 2 or 3 kernel shards
+        k, v = nn.Dense(features=self.config.dim_heads * kv_heads * 2, use_bias=False, dtype=self.config.dtype)(x).split(2, axis=-1)  # TODO: Check if it should be 2 or 3 kernel shards
 
-        q = rearrange(q, 'b n (h d) -> b h n d', h=self.block_config.num_heads)
+        # every query head in a group shares the same k/v head, so the heads are folded into the
+        # query length and the whole group is contracted as one (h n) x j matmul per batch element
+        q = rearrange(q, 'b n (g h d) -> b g (h n) d', g=kv_heads)
+        k, v = rearrange_many((k, v), 'b n (g d) -> b g n d', g=kv_heads)
         q = q * scale
 
-        q = with_sharding_constraint(q, ("batch", "length", "heads", "kv"))
-        k = with_sharding_constraint(k, ("batch", "length", "kv"))
-        v = with_sharding_constraint(v, ("batch", "length", "kv"))
+        q = with_sharding_constraint(q, ("batch", "heads", "length", "kv"))
+        k = with_sharding_constraint(k, ("batch", "heads", "length", "kv"))
+        v = with_sharding_constraint(v, ("batch", "heads", "length", "kv"))
 
         null_kv = self.param(
             'null_kv', nn.initializers.lecun_normal(), (2, self.config.dim_heads))
         null_kv = null_kv.astype(self.config.dtype)
         # null kv for classifier free guidance
-        nk, nv = repeat_many(jax_unstack(null_kv, axis=-2), 'd -> b 1 d', b=b)
-        nk = with_sharding_constraint(nk, ("batch", "heads", "kv"))
-        nv = with_sharding_constraint(nv, ("batch", "heads", "kv"))
+        nk, nv = repeat_many(jax_unstack(null_kv, axis=-2), 'd -> b g 1 d', b=b, g=kv_heads)
+        nk = with_sharding_constraint(nk, ("batch", "heads", "length", "kv"))
+        nv = with_sharding_constraint(nv, ("batch", "heads", "length", "kv"))
 
         k = jnp.concatenate((k, nk), axis=-2)
         v = jnp.concatenate((v, nv), axis=-2)
 
-        k = with_sharding_constraint(k, ("batch", "heads", "kv"))
-        v = with_sharding_constraint(v, ("batch", "heads", "kv"))
-
         if exists(context):
             context_hidden = nn.LayerNorm()(context)
             context_hidden = nn.Dense(
-                features=self.config.dim_heads*2, dtype=self.config.dtype)(context_hidden)
-            ck, cv = context_hidden.split(2, axis=-1)
+                features=self.config.dim_heads * kv_heads * 2, dtype=self.config.dtype)(context_hidden)
+            ck, cv = rearrange_many(context_hidden.split(2, axis=-1), 'b n (g d) -> b g n d', g=kv_heads)
 
             k = jnp.concatenate((k, ck), axis=-2)
             v = jnp.concatenate((v, cv), axis=-2)
 
-        sim = jnp.einsum('b h i d, b j d -> b h i j', q, k)
+        sim = jnp.einsum('b g i d, b g j d -> b g i j', q, k)
         if exists(attn_bias):
+            if attn_bias.ndim == 3:
+                # shared across heads, one bias per batch element (or per window, see WindowAttention)
+                attn_bias = repeat(attn_bias, 'w i j -> w 1 (h i) j', h=self.block_config.num_heads // kv_heads)
+            else:
+                attn_bias = rearrange(attn_bias, 'w (g h) i j -> w g (h i) j', g=kv_heads)
+            # the bias may cover only the trailing windows of the batch dim and is broadcast over the rest
+            sim = rearrange(sim, '(b w) g i j -> b w g i j', w=attn_bias.shape[0])
             sim = sim + attn_bias
+            sim = rearrange(sim, 'b w g i j -> (b w) g i j')
 
         if exists(mask):
             mask = jnp.pad(mask, (1, 0), constant_values=True)
@@ -108,28 +117,76 @@ class Attention(nn.Module):
 
         attn = nn.softmax(sim, axis=-1)
         attn.astype(self.config.dtype)
-        attn = with_sharding_constraint(attn, ("batch", "length", "heads", "kv"))
+        attn = with_sharding_constraint(attn, ("batch", "heads", "length", "kv"))
 
-        out = jnp.einsum('b h i j, b j d -> b h i d', attn, v)
+        out = jnp.einsum('b g i j, b g j d -> b g i d', attn, v)
 
-        out = rearrange(out, 'b h n d -> b n (h d)')
+        out = rearrange(out, 'b g (h n) d -> b n (g h d)', n=n)
 
         out = nn.Dense(features=self.block_config.dim, use_bias=False)(out)
         out = LayerNorm()(out)
         return out
 
 
+def shifted_window_bias(height, width, window_size, shift):
+    # tokens that were wrapped around by the cyclic shift must not attend to their new neighbours
+    regions = np.zeros((height, width), dtype=np.int32)
+    slices = (slice(0, -window_size), slice(-window_size, -shift), slice(-shift, None))
+    region = 0
+    for h_slice in slices:
+        for w_slice in slices:
+            regions[h_slice, w_slice] = region
+            region += 1
+    regions = rearrange(regions, '(h s1) (w s2) -> (h w) (s1 s2)', s1=window_size, s2=window_size)
+    bias = np.where(regions[:, :, None] != regions[:, None, :], -1e9, 0.0).astype(np.float32)
+    # the null key is appended after the window's own keys and is always visible
+    return np.pad(bias, ((0, 0), (0, 0), (0, 1)))
+
+
+class WindowAttention(nn.Module):
+    config: UnetConfig
+    block_config: BlockConfig
+    shift: int = 0
+
+    @nn.compact
+    def __call__(self, x):
+        b, h, w, c = x.shape
+        window_size = self.block_config.attention_window
+        assert h % window_size == 0 and w % window_size == 0, f"feature map {h}x{w} is not divisible by attention_window {window_size}"
+
+        attn_bias = None
+        if self.shift > 0:
+            x = jnp.roll(x, (-self.shift, -self.shift), axis=(1, 2))
+            attn_bias = jnp.asarray(shifted_window_bias(h, w, window_size, self.shift), dtype=self.config.dtype)
+
+        x = rearrange(x, 'b (h s1) (w s2) c -> (b h w) (s1 s2) c', s1=window_size, s2=window_size)
+        x = Attention(config=self.config, block_config=self.block_config)(x, attn_bias=attn_bias)
+        x = rearrange(x, '(b h w) (s1 s2) c -> b (h s1) (w s2) c', b=b, h=h // window_size, s1=window_size)
+
+        if self.shift > 0:
+            x = jnp.roll(x, (self.shift, self.shift), axis=(1, 2))
+        return x
+
+
 class TransformerBlock(nn.Module):
     config: UnetConfig
     block_config: BlockConfig
 
     @nn.compact
     def __call__(self, x, context=None):
-        # TODO: implement attention_depth
         # TODO: maybe implement pack/unpack
-        x = EinopsToAndFrom(Attention(config=self.config, block_config=self.block_config), 'b h w c', 'b (h w) c')(x, context=context) + x
-        x = with_sharding_constraint(x, ("batch", "length", "embed"))
-        x = ChannelFeedForward(dim=self.block_config.dim, mult=self.config.ff_mult)(x) + x # TODO: Lucidrains uses FeedForward instead of ChannelFeedForward
+        window_size = self.block_config.attention_window
+        # windows only pay off once the feature map is larger than a single window
+        windowed = window_size > 0 and (x.shape[1] > window_size or x.shape[2] > window_size)
+        assert not (windowed and exists(context)), "windowed attention does not attend to a context"
+        for depth in range(self.block_config.attention_depth):
+            if windowed:
+                shift = window_size // 2 if self.block_config.shifted_windows and depth % 2 == 1 else 0
+                x = WindowAttention(config=self.config, block_config=self.block_config, shift=shift)(x) + x
+            else:
+                x = EinopsToAndFrom(Attention(config=self.config, block_config=self.block_config), 'b h w c', 'b (h w) c')(x, context=context) + x
+            x = with_sharding_constraint(x, ("batch", "length", "embed"))
+            x = ChannelFeedForward(dim=self.block_config.dim, mult=self.config.ff_mult)(x) + x # TODO: Lucidrains uses FeedForward instead of ChannelFeedForward
         return x
 
 class FeedForward(nn.Module):
@@ -161,17 +218,27 @@ class ChannelFeedForward(nn.Module):
         return x
 
 
+def layer_norm_moments(x, axis=-1):
+    # single pass over x: E[x] and E[x^2] are reduced together (XLA fuses both into one
+    # multi-output reduction) and accumulated in fp32 even for bf16 activations
+    x = x.astype(jnp.float32)
+    mean = jnp.mean(x, axis=axis, keepdims=True)
+    mean_sq = jnp.mean(jnp.square(x), axis=axis, keepdims=True)
+    var = jnp.maximum(mean_sq - jnp.square(mean), 0.0)
+    return mean, var
+
+
 class LayerNorm(nn.Module):
     axis: int = -1
 
     @nn.compact
     def __call__(self, x):
-        var = jnp.var(x, axis=self.axis, keepdims=True)
-        mean = jnp.mean(x, axis=self.axis, keepdims=True)
+        mean, var = layer_norm_moments(x, axis=self.axis)
         eps:float = 1e-5 if x.dtype == jnp.float32 else 1e-3
 
         g = self.param('g', nn.initializers.ones, (x.shape[-1], *((1,) * (-self.axis - 1))))
-        return (x - mean) / jnp.sqrt(var + eps) * g
+        out = (x.astype(jnp.float32) - mean) * jax.lax.rsqrt(var + eps) * g
+        return out.astype(x.dtype)
 
 ChannelLayerNorm = partial(LayerNorm, axis=(-1))
 class ChannelLayerNorm2(nn.Module):
@@ -236,10 +303,10 @@ class CrossAttention(nn.Module):
         sim = jnp.einsum('b h i d, b h j d -> b h i j', q, k)
 
         if exists(mask):
-            mask = jnp.pad(mask, (1, 0), value=True)
+            # mask is True for keys that may be attended to, the null key in front always can
+            mask = jnp.pad(mask, ((0, 0), (1, 0)), constant_values=True)
             mask = rearrange(mask, 'b j -> b 1 1 j')
-            # TODO check if mask should be inverted and if params are correct
-            sim = jnp.where(mask, -jnp.inf, sim)
+            sim = jnp.where(mask, sim, -jnp.finfo(sim.dtype).max)
 
         attn = nn.softmax(sim, axis=-1)
         
@@ -306,6 +373,8 @@ class TextConditioning(nn.Module):
 
     @nn.compact
     def __call__(self, text_embeds, text_mask, time_cond, time_tokens, rng):
+        # returns the conditioning tokens with their key mask (None without a text mask), padding up to the
+        # bucket length is masked out so the bucket a caption lands in does not change the conditioning
         text_tokens = None
         if exists(text_embeds):
             batch_size = text_embeds.shape[0]
@@ -316,32 +385,27 @@ class TextConditioning(nn.Module):
 
             text_tokens = nn.Dense(features=self.cond_dim)(text_embeds)
             text_tokens = text_tokens[:, :self.max_token_length]
-            
-            if exists(text_mask):
-                text_mask = text_mask[:, :self.max_token_length]
-            
+            # no padding back to max_token_length, text batches keep the length of their bucket
             text_tokens_len = text_tokens.shape[1]
-            remainder = self.max_token_length - text_tokens_len
-            
-            if remainder > 0:
-                # the text_tokens shape is (batch_size, max_token_length, cond_dim)
-                text_tokens = jnp.pad(text_tokens, ((0, 0), (0, remainder))) # TODO: check how to do padding here
-                # text_tokens = F.pad(text_tokens, (0, 0, 0, remainder))
-            
-            rng, key = jax.random.split(rng)
-            if remainder > 0:
-                text_mask = jnp.pad(text_mask, (0, remainder), value=False)
+
+            if exists(text_mask):
+                text_mask = text_mask[:, :self.max_token_length].astype(bool)
                 text_mask = rearrange(text_mask, 'b n -> b n 1')
                 text_keep_mask_embed = text_mask & text_keep_mask_embed
 
             null_text_embed = self.param('null_text_embed', nn.initializers.lecun_normal(), (1, self.max_token_length, self.cond_dim))
             # TODO: should this be inverted?
             text_tokens = jnp.where(
-                text_keep_mask_embed, text_tokens, null_text_embed) # TODO: check this too
+                text_keep_mask_embed, text_tokens, null_text_embed[:, :text_tokens_len]) # TODO: check this too
 
             # TODO: add attention pooling
-            
-            mean_pooled_text_tokens = jnp.mean(text_tokens, axis=-2)
+
+            if exists(text_mask):
+                # mean over the caption's own tokens only
+                valid = text_mask.astype(text_tokens.dtype)
+                mean_pooled_text_tokens = jnp.sum(text_tokens * valid, axis=-2) / jnp.maximum(jnp.sum(valid, axis=-2), 1)
+            else:
+                mean_pooled_text_tokens = jnp.mean(text_tokens, axis=-2)
             
             text_hiddens = nn.LayerNorm()(mean_pooled_text_tokens)
             text_hiddens = nn.Dense(features=self.time_cond_dim, dtype=self.dtype)(text_hiddens)
@@ -358,7 +422,12 @@ class TextConditioning(nn.Module):
         c = time_tokens if not exists(text_embeds) else jnp.concatenate([
             time_tokens, text_tokens], axis=-2)
         c = nn.LayerNorm()(c)
-        return time_cond, c
+        c_mask = None
+        if exists(text_embeds) and exists(text_mask):
+            # time tokens are always attended to
+            time_mask = jnp.ones(time_tokens.shape[:2], dtype=bool)
+            c_mask = jnp.concatenate([time_mask, text_mask[..., 0]], axis=-1)
+        return time_cond, c, c_mask
 
 
 class Block(nn.Module):
@@ -382,7 +451,7 @@ class ResnetBlock(nn.Module):
     block_config: BlockConfig
 
     @nn.compact
-    def __call__(self, x, time_emb=None, cond=None):
+    def __call__(self, x, time_emb=None, cond=None, cond_mask=None):
         scale_shift = None
         if exists(time_emb):
             time_emb = nn.silu(time_emb)
@@ -393,7 +462,7 @@ class ResnetBlock(nn.Module):
         if exists(cond) and self.block_config.num_heads > 0:
             # TODO: maybe use pack like lucidrains, but maybe Einops is better, at least notationally
             h = EinopsToAndFrom(CrossAttention(config=self.config, block_config=self.block_config),
-                                'b h w c', ' b (h w) c')(h, context=cond) + h
+                                'b h w c', ' b (h w) c')(h, context=cond, mask=cond_mask) + h
 
         h = Block(self.block_config.dim)(h, scale_shift=scale_shift)
         # TODO: Maybe implement global context like lucidrains
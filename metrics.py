@@ -0,0 +1,152 @@
+import bisect
+import contextlib
+import time
+import uuid
+
+import ray
+
+# upper bounds in seconds of the latency histogram buckets, 1ms to ~2 minutes, the last bucket is unbounded
+LATENCY_BUCKETS = [0.001 * 2 ** i for i in range(18)]
+AGGREGATOR_NAME = "pipeline_metrics"
+
+
+class StageMetrics:
+    """Counters and a latency histogram of one pipeline stage in one actor or task.
+
+    Wrap the work on a batch in `with metrics.busy(items_in):` and the waits on other stages in
+    `with metrics.idle():`, so the aggregator can tell a stage that is slow from one that is starved or blocked. The
+    cumulative numbers are pushed to the MetricsAggregator at most every `report_every` seconds, from any of
+    busy, idle, count or set_queue_depth.
+    """
+
+    def __init__(self, stage, report_every=10.0):
+        self.stage = stage
+        self.worker = uuid.uuid4().hex[:8]
+        self.report_every = report_every
+        self.items_in = 0
+        self.items_out = 0
+        self.busy_seconds = 0.0
+        self.idle_seconds = 0.0
+        self.queue_depth = None
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.last_report = time.time()
+        self.aggregator = None
+
+    @contextlib.contextmanager
+    def busy(self, items_in=0):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            latency = time.time() - start_time
+            self.busy_seconds += latency
+            self.items_in += items_in
+            self.histogram[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            self.maybe_report()
+
+    @contextlib.contextmanager
+    def idle(self):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.idle_seconds += time.time() - start_time
+            self.maybe_report()
+
+    def count(self, items_in=0, items_out=0):
+        self.items_in += items_in
+        self.items_out += items_out
+        # stages that only wait and count (e.g. the trainer's consumption) report from here
+        self.maybe_report()
+
+    def set_queue_depth(self, depth):
+        self.queue_depth = depth
+        self.maybe_report()
+
+    def snapshot(self):
+        return {
+            "time": time.time(),
+            "items_in": self.items_in,
+            "items_out": self.items_out,
+            "busy_seconds": self.busy_seconds,
+            "idle_seconds": self.idle_seconds,
+            "queue_depth": self.queue_depth,
+            "histogram": list(self.histogram),
+        }
+
+    def maybe_report(self):
+        if time.time() - self.last_report < self.report_every or not ray.is_initialized():
+            return
+        self.last_report = time.time()
+        if self.aggregator is None:
+            self.aggregator = get_aggregator()
+        # fire and forget, reporting never blocks the stage
+        self.aggregator.report.remote(self.stage, self.worker, self.snapshot())
+
+
+def _percentile(histogram, q):
+    total = sum(histogram)
+    if total == 0:
+        return None
+    count = 0
+    for bucket, n in enumerate(histogram):
+        count += n
+        if count >= q * total:
+            return LATENCY_BUCKETS[bucket] if bucket < len(LATENCY_BUCKETS) else float("inf")
+
+
+@ray.remote(num_cpus=0)
+class MetricsAggregator:
+    """Collects StageMetrics snapshots from every actor and reports rates per stage, summed over workers."""
+
+    def __init__(self):
+        self.latest = {}  # (stage, worker) -> most recent snapshot
+        self.previous = {}  # (stage, worker) -> the snapshot before it, to compute rates
+
+    def report(self, stage, worker, snapshot):
+        if (stage, worker) in self.latest:
+            self.previous[(stage, worker)] = self.latest[(stage, worker)]
+        self.latest[(stage, worker)] = snapshot
+
+    def summary(self):
+        stages = {}
+        for (stage, worker), snapshot in self.latest.items():
+            summary = stages.setdefault(stage, {
+                "workers": 0, "items_in_per_second": 0.0, "items_out_per_second": 0.0,
+                "busy_fraction": 0.0, "idle_fraction": 0.0, "queue_depth": None, "histogram": [0] * (len(LATENCY_BUCKETS) + 1)})
+            summary["workers"] += 1
+            previous = self.previous.get((stage, worker))
+            if previous is not None:
+                elapsed = max(snapshot["time"] - previous["time"], 1e-6)
+                summary["items_in_per_second"] += (snapshot["items_in"] - previous["items_in"]) / elapsed
+                summary["items_out_per_second"] += (snapshot["items_out"] - previous["items_out"]) / elapsed
+                summary["busy_fraction"] += (snapshot["busy_seconds"] - previous["busy_seconds"]) / elapsed
+                summary["idle_fraction"] += (snapshot["idle_seconds"] - previous["idle_seconds"]) / elapsed
+            if snapshot["queue_depth"] is not None:
+                summary["queue_depth"] = (summary["queue_depth"] or 0) + snapshot["queue_depth"]
+            summary["histogram"] = [a + b for a, b in zip(summary["histogram"], snapshot["histogram"])]
+        for summary in stages.values():
+            # averages over the workers of the stage, a stage that is busy close to 100% is the bottleneck
+            summary["busy_fraction"] /= summary["workers"]
+            summary["idle_fraction"] /= summary["workers"]
+            summary["latency_p50"] = _percentile(summary["histogram"], 0.5)
+            summary["latency_p95"] = _percentile(summary["histogram"], 0.95)
+            del summary["histogram"]
+        return stages
+
+    def format_summary(self):
+        lines = []
+        for stage, summary in sorted(self.summary().items()):
+            line = (f"{stage:>24}: {summary['workers']:3d} workers, in {summary['items_in_per_second']:9.1f}/s, "
+                    f"out {summary['items_out_per_second']:9.1f}/s, busy {summary['busy_fraction']:6.1%}, idle {summary['idle_fraction']:6.1%}")
+            if summary["latency_p50"] is not None:
+                line += f", p50 {summary['latency_p50']:.3f}s, p95 {summary['latency_p95']:.3f}s"
+            if summary["queue_depth"] is not None:
+                line += f", queue {summary['queue_depth']}"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+def get_aggregator():
+    # one named aggregator per cluster, created by whichever actor reports first
+    return MetricsAggregator.options(name=AGGREGATOR_NAME, get_if_exists=True).remote()
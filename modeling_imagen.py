@@ -8,6 +8,8 @@ from layers import ResnetBlock, UpsampleCombiner, CrossEmbedLayer, TextCondition
 from jax.experimental.pjit import PartitionSpec as P
 import partitioning as nnp
 from flax.linen import partitioning as nn_partitioning
+from flax.core.frozen_dict import unfreeze
+from flax.traverse_util import flatten_dict
 
 from config import UnetConfig, ImagenConfig
 
@@ -64,7 +66,7 @@ class EfficentUNet(nn.Module):
             t = t + lowres_t
             time_tokens = jnp.concatenate([time_tokens, lowres_time_tokens], axis=-2)
 
-        t, c = TextConditioning(cond_dim=self.config.cond_dim, time_cond_dim=self.config.time_conditiong_dim, max_token_length=self.config.max_token_len, cond_drop_prob=condition_drop_prob)(texts, attention_masks, t, time_tokens, rng)
+        t, c, c_mask = TextConditioning(cond_dim=self.config.cond_dim, time_cond_dim=self.config.time_conditiong_dim, max_token_length=self.config.max_token_len, cond_drop_prob=condition_drop_prob)(texts, attention_masks, t, time_tokens, rng)
         
         # TODO: add init resnet block
 
@@ -78,7 +80,7 @@ class EfficentUNet(nn.Module):
         hiddens = []
         for block_config in self.config.block_configs:
             x = Downsample(config=self.config, block_config=block_config)(x)
-            x = ResnetBlock(config=self.config, block_config=block_config)(x, t, c)
+            x = ResnetBlock(config=self.config, block_config=block_config)(x, t, c, c_mask)
             for _ in range(block_config.num_resnet_blocks):
                 x = ResnetBlock(config=self.config, block_config=block_config)(x)
                 x = with_sharding_constraint(x, ("batch", "height", "width", "embed"))
@@ -90,17 +92,17 @@ class EfficentUNet(nn.Module):
         
         # middle
         block_config = self.config.block_configs[-1]
-        x = ResnetBlock(config=self.config, block_config=block_config)(x, t, c)
+        x = ResnetBlock(config=self.config, block_config=block_config)(x, t, c, c_mask)
         if block_config.num_heads > 0:
             x = EinopsToAndFrom(Attention(config=self.config, block_config=block_config), 'b h w c', 'b (h w) c')(x)
-        x = ResnetBlock(config=self.config, block_config=block_config)(x, t, c)
+        x = ResnetBlock(config=self.config, block_config=block_config)(x, t, c, c_mask)
         
         # Upsample
         add_skip_connection = lambda x: jnp.concatenate([x, hiddens.pop()], axis=-1)
         up_hiddens = []
         for block_config in reversed(self.config.block_configs):
             x = add_skip_connection(x)
-            x = ResnetBlock(config=self.config, block_config=block_config)(x, t, c)
+            x = ResnetBlock(config=self.config, block_config=block_config)(x, t, c, c_mask)
             for _ in range(block_config.num_resnet_blocks):
                 x = add_skip_connection(x)
                 x = with_sharding_constraint(x, P("batch", "height", "width", "embed"))
@@ -115,8 +117,34 @@ class EfficentUNet(nn.Module):
         x = UpsampleCombiner(config=self.config)(x, up_hiddens)
         x = jnp.concatenate([x, init_conv_residual], axis=-1)
         
-        x = ResnetBlock(config=self.config, block_config=block_config)(x, t, c)
+        x = ResnetBlock(config=self.config, block_config=block_config)(x, t, c, c_mask)
             
         # x = nn.Dense(features=3, dtype=self.dtype)(x)
         x = nn.Conv(features=3, kernel_size=(3, 3), strides=1, dtype=self.config.dtype, padding=1)(x)
         return x
+
+
+def test():
+    # every parameter of a unet with windowed and stacked attention must have a partition rule
+    import jax
+    config = UnetConfig.create(dim=64, dim_mults=(1, 2), num_heads=(0, 4), num_resnet_blocks=1,
+                               attention_depth=2, attention_window=4)
+    unet = EfficentUNet(config=config)
+    batch_size, img_size, text_length = 2, 32, 16
+    key = jax.random.PRNGKey(0)
+    params = jax.eval_shape(lambda key: unet.init(
+        key,
+        jnp.ones((batch_size, img_size, img_size, 3)),
+        jnp.ones(batch_size, dtype=jnp.int16),
+        jnp.ones((batch_size, text_length, config.token_embedding_dim)),
+        jnp.ones((batch_size, text_length)),
+        0.1, None, None, key), key)
+    flat = flatten_dict(unfreeze(params))
+    assert any("WindowAttention_0" in path for path in flat), "attention_window did not add windowed attention"
+    assert any("ChannelFeedForward_1" in path for path in flat), "attention_depth did not stack attention layers"
+    nnp.set_partitions(params)
+    print("Partition rules cover windowed and stacked attention")
+
+
+if __name__ == "__main__":
+    test()
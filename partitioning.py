@@ -89,9 +89,13 @@ def _get_partition_rules():
         (('params', 'TransformerBlock_.*', 'Attention_.*', 'LayerNorm_.*', 'g'), P(None,)),
         (('params', 'TransformerBlock_.*', 'Attention_.*', 'null_kv'), P(None, None)),
         
-        (('params', 'TransformerBlock_.*', 'ChannelFeedForward_0', 'Conv_.*', "kernel"), P(None, None, None, None)),
-        (('params', 'TransformerBlock_.*', 'ChannelFeedForward_0', 'Conv_.*', "bias"), P(None,)),
-        (('params', 'TransformerBlock_.*', 'ChannelFeedForward_0', 'LayerNorm_.*', "g"), P(None,)),
+        (('params', 'TransformerBlock_.*', 'WindowAttention_.*', 'Attention_.*', 'Dense_.*', 'kernel'), P(None, None)),
+        (('params', 'TransformerBlock_.*', 'WindowAttention_.*', 'Attention_.*', 'LayerNorm_.*', 'g'), P(None,)),
+        (('params', 'TransformerBlock_.*', 'WindowAttention_.*', 'Attention_.*', 'null_kv'), P(None, None)),
+
+        (('params', 'TransformerBlock_.*', 'ChannelFeedForward_.*', 'Conv_.*', "kernel"), P(None, None, None, None)),
+        (('params', 'TransformerBlock_.*', 'ChannelFeedForward_.*', 'Conv_.*', "bias"), P(None,)),
+        (('params', 'TransformerBlock_.*', 'ChannelFeedForward_.*', 'LayerNorm_.*', "g"), P(None,)),
         
         (("params", "ResnetBlock_.*", "CrossAttention_.*", "Dense_.*","kernel"), P(None, None)),
         (("params", "ResnetBlock_.*", "CrossAttention_.*", "null_kv"), P(None, None)),
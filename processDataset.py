@@ -2,9 +2,6 @@ import gc
 import pickle
 import random
 import time
-from googleapiclient import errors
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
 import io
 import cv2
 import numpy as np
@@ -12,163 +9,105 @@ import psutil
 import ray
 import urllib3
 import T5Utils
+from shards import SHARD_SUFFIX, download_shard, write_shard
+from storage import drive_storage, prefetch
+from image_processing import ImagePreprocessor
+from dedup import PerceptualHashIndex, image_hash
+from metrics import StageMetrics, get_aggregator
 import logging
 import os
-from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
-from googleapiclient.errors import HttpError
 
 os.environ["TCMALLOC_LARGE_ALLOC_REPORT_THRESHOLD"] = "2000000000000"
 
 # ray.init(logging_level=logging.ERROR, log_to_driver=False)
 
-creds = Credentials.from_authorized_user_file(
-            'token.json',
-            scopes=["https://www.googleapis.com/auth/drive"]
-        )
+INPUT_FOLDER = "1QwRiS6rIfWPrzrVBU9x1Y8S6kHXKZnvN"
+OUTPUT_FOLDER = "1fUYXHjDJRhBaDJM3TdxIhGh4NZHi4qM0"
+OUTPUT_DRIVE = "LAION-ART-PROCESSED"
 
-# 3. Use the `drive_service.files().list()` method to retrieve a list of files in the specified folder
 
-
-def list_files(folder_id="1QwRiS6rIfWPrzrVBU9x1Y8S6kHXKZnvN"):
-    drive_service = build('drive', 'v3', credentials=creds)
-    files = []
-    try:
-        page_token = None
-        while True:
-            query = f"'{folder_id}' in parents"
-            response = drive_service.files().list(q=f"{query}",
-                                                  fields='nextPageToken, '
-                                                  'files(id, name, mimeType)',
-                                                  includeItemsFromAllDrives=True,
-                                                  supportsAllDrives=True, 
-                                                  corpora="allDrives",
-                                                  pageToken=page_token).execute()
-            for file in response.get('files', []):
-                # Process the file
-                files.append(file)
-                # print(F'Found file: {file.get("name")} ({file.get("id")})')
-                
-            page_token = response.get('nextPageToken', None)
-            if page_token is None:
-                break
-    except errors.HttpError as error:
-        print(F'An error occurred: {error}')
-        files = None
-    return files
-
-def download_pickle(file):
-    drive_service = build('drive', 'v3', credentials=creds)
-    request = drive_service.files().get_media(fileId=file.get('id')).execute()
-    data = pickle.load(io.BytesIO(request))
-    return data
+def list_files(folder_id=INPUT_FOLDER):
+    return drive_storage(folder_id).list()
 
 @ray.remote
 class DatasetFetcher:
     def __init__(self):
         self.files = list_files()
         self.index = 0
-        self.uploaded_ids = []
-        for file in list_files("1fUYXHjDJRhBaDJM3TdxIhGh4NZHi4qM0"):
+        self.uploaded_ids = set()
+        for file in list_files(OUTPUT_FOLDER):
             if "12" in file.get('name'):
                 print(file.get('name'))
-            self.uploaded_ids.append(file.get('name'))
-        self.sent_ids = []
+            # processed files are uploaded as shards, compare names without the extension
+            self.uploaded_ids.add(os.path.splitext(file.get('name'))[0])
+        self.sent_ids = set()
+        # perceptual hashes of every image sent to the shards so far
+        self.image_hashes = PerceptualHashIndex()
     def get_data(self):
         self.index += 1
         if self.index % 100 == 0:
             self.files = list_files()
-        while self.files[self.index % len(self.files)].get('name') in self.uploaded_ids or self.files[self.index % len(self.files)].get('name') in self.sent_ids:
+        while os.path.splitext(self.files[self.index % len(self.files)].get('name'))[0] in self.uploaded_ids or self.files[self.index % len(self.files)].get('name') in self.sent_ids:
             self.index += 1
-        self.sent_ids.append(self.files[self.index % len(self.files)].get('name'))
+        self.sent_ids.add(self.files[self.index % len(self.files)].get('name'))
         return self.files[self.index % len(self.files)]
-        
-def processImage(img):
-    # image is a pillow image
-    height_diff = img.size[1] - img.size[0]
-    width_diff = img.size[0] - img.size[1]
-    height_diff = height_diff // 2
-    width_diff = width_diff // 2
-    width_diff = width_diff if width_diff > 0 else 0
-    height_diff = height_diff if height_diff > 0 else 0
-    img = img.crop((width_diff, height_diff, min(img.size[0], img.size[1]) + width_diff, min(img.size[0], img.size[1]) + height_diff))
-    img = img.resize((256, 256))
-    np_img = np.array(img, dtype=np.uint8)
-    if len(np_img.shape) == 2:
-        np_img = cv2.cvtColor(np_img, cv2.COLOR_GRAY2RGB)
-    if np_img.shape[2] == 4:
-        np_img = cv2.cvtColor(np_img, cv2.COLOR_RGBA2RGB)
-    if np_img.shape[2] == 1:
-        np_img = cv2.cvtColor(np_img, cv2.COLOR_GRAY2RGB)
-    return np_img
-
-
-
-def upload_pickle_to_google_drive(data, pickle_file_name, creds=None, upload_data_without_file=False):
-    # Set the credentials object with the required scope for accessing Google Drive
-    if creds is None:
-        creds = Credentials.from_authorized_user_file(
-            'token.json',
-            scopes=["https://www.googleapis.com/auth/drive"]
-        )
 
-    # Build the service for interacting with Google Drive
-    service = build("drive", "v3", credentials=creds)
-
-
-    # Obtain the ID of the shared drive
-    # Replace "SHARED_DRIVE_NAME" with the name of the shared drive
-    query = "name='LAION-ART-PROCESSED'"
-    results = service.files().list(
-        q=query, 
-        fields="nextPageToken, files(id, name)", 
-        includeItemsFromAllDrives=True,
-        supportsAllDrives=True,
-        corpora="allDrives").execute()
-    print(results)
-
-    # results2 = service.files().list().execute()
-    # print(results2)
-    shared_drive_id = results["files"][0]["id"]
-
-
-    # Dump the data you want to upload to a pickle file
-    if not upload_data_without_file:
-        with open(pickle_file_name, "wb") as f:
-            pickle.dump(data,f)
-            f.close()
+    def keep_new_images(self, hashes):
+        # which images are not near duplicates of one processed before
+        return self.image_hashes.add_new(hashes)
+        
 
-    try:
-        # Upload the pickle file to Google Drive
-        file_metadata = {
-            "name": pickle_file_name,
-            "parents": [shared_drive_id]
-            }
-        media = None
-        if not upload_data_without_file:
-            media = MediaFileUpload(pickle_file_name, resumable=True, mimetype='unknown/pkl')
-        else: 
-            media = MediaIoBaseUpload(io.BytesIO(data), mimetype='unknown/pkl', resumable=True)
-        file = service.files().create(body=file_metadata, media_body=media, fields='id', supportsAllDrives=True).execute()
-        print(f"File uploaded: {file.get('name')} with ID: {file.get('id')}")
 
-    except HttpError as error:
-        print(f"An error occurred while uploading the file: {error}")
-        # Handle the error
 
 @ray.remote
 class DataCollector:
     def __init__(self, dataset):
         self.dataset = dataset
+        self.preprocessor = ImagePreprocessor(size=256)
+        self.download_metrics = StageMetrics("download")
+        self.preprocess_metrics = StageMetrics("preprocess")
+        self.upload_metrics = StageMetrics("upload")
+    def load(self, file):
+        # runs on the prefetch threads, the next files download while the current one is processed
+        with self.download_metrics.busy(1):
+            if file.get('name').endswith(SHARD_SUFFIX):
+                shard = download_shard(drive_storage(INPUT_FOLDER), file, "downloads")
+                images = shard.images_bytes() # list of jpeg bytes
+                texts = shard.captions()
+                os.remove(shard.path)
+            else:
+                data = pickle.loads(drive_storage(INPUT_FOLDER).read(file))
+                images = data[0] # list of pil images
+                texts = data[1]
+        self.download_metrics.count(items_out=len(texts))
+        return file, images, texts
+
     def start(self):
+        files = iter(lambda: ray.get(self.dataset.get_data.remote()), None)
+        batches = prefetch(self.load, files)
         while True:
-            file = ray.get(self.dataset.get_data.remote())
-            data = download_pickle(file)
-            images = data[0] # list of pil images
-            texts = data[1]
-            # convert pil images to numpy arrays
-            images = [processImage(image) for image in images]
-            data = (images, texts)
-            upload_pickle_to_google_drive(data, f"{file.get('name')}")
+            # waiting here means downloads are the bottleneck
+            with self.preprocess_metrics.idle():
+                batch = next(batches, None)
+            if batch is None:
+                break
+            file, images, texts = batch
+            with self.preprocess_metrics.busy(len(texts)):
+                # pil images or jpeg bytes to a (n, 256, 256, 3) uint8 batch
+                images = self.preprocessor(images)
+                keep = np.asarray(ray.get(self.dataset.keep_new_images.remote([image_hash(image) for image in images])))
+                images = images[keep]
+                texts = [text for text, keep_text in zip(texts, keep) if keep_text]
+            self.preprocess_metrics.count(items_out=len(texts))
+            print(f"Preprocessing: {self.preprocessor.images_per_second_per_core:.0f} images/sec/core")
+            if len(images) == 0:
+                continue
+            with self.upload_metrics.busy(len(images)):
+                shard_name = os.path.splitext(file.get('name'))[0] + SHARD_SUFFIX
+                write_shard(shard_name, images, texts)
+                drive_storage(shared_drive_name=OUTPUT_DRIVE).upload(shard_name, shard_name)
+                os.remove(shard_name)
+            self.upload_metrics.count(items_out=len(images))
             
             
 
@@ -186,6 +125,8 @@ def test():
     datamanager = DataManager.remote(1024)
     total_processed = 0
     while True:
-        time.sleep(1)
+        # progress report only, the collectors do not wait on it
+        time.sleep(30)
+        print(ray.get(get_aggregator().format_summary.remote()))
 if __name__ == "__main__":
     test()
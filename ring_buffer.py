@@ -0,0 +1,107 @@
+import numpy as np
+
+
+class RingBuffer:
+    """FIFO of fixed-shape examples stored column-wise in preallocated numpy slabs.
+
+    Every column (images, embeddings, masks, ...) gets its own (capacity, *example_shape) slab, allocated
+    from the first batch that is added. put/get copy whole slices, so moving n examples costs O(n) with no
+    per-example python objects. Backpressure belongs to the owner (see flow_control.Watermarks), which only
+    checks for space before a put, so the last batch may overshoot: the slabs double to absorb it, but never
+    beyond max_capacity (4x capacity by default), past which put fails instead of growing without bound.
+    """
+
+    def __init__(self, capacity, max_capacity=None):
+        self.capacity = capacity
+        self.max_capacity = 4 * capacity if max_capacity is None else max_capacity
+        self.slabs = None
+        self.head = 0  # index of the oldest example
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _allocate(self, columns, capacity):
+        slabs = {}
+        for name, values in columns.items():
+            # strings are kept as object references instead of fixed-width unicode
+            dtype = object if values.dtype.kind in "UO" else values.dtype
+            slabs[name] = np.empty((capacity, *values.shape[1:]), dtype=dtype)
+        return slabs
+
+    def _spans(self, start, n):
+        # (slab slice, data slice) pairs covering n slots from start, split where the ring wraps around
+        first = min(n, self.capacity - start)
+        spans = [(slice(start, start + first), slice(0, first))]
+        if first < n:
+            spans.append((slice(0, n - first), slice(first, n)))
+        return spans
+
+    def _grow(self, min_capacity):
+        assert min_capacity <= self.max_capacity, \
+            f"{min_capacity} examples do not fit into the ring buffer (max_capacity {self.max_capacity}), producers must wait for space"
+        capacity = self.capacity
+        while capacity < min_capacity:
+            capacity *= 2
+        capacity = min(capacity, self.max_capacity)
+        columns = self.get(self.size)
+        self.capacity = capacity
+        self.slabs = self._allocate(columns, capacity)
+        self.head = 0
+        self.size = 0
+        self.put(**columns)
+
+    def put(self, **columns):
+        columns = {name: np.asarray(values) for name, values in columns.items()}
+        n = len(next(iter(columns.values())))
+        if n == 0:
+            return
+        if self.slabs is None:
+            assert n <= self.max_capacity, f"batch of {n} examples exceeds the ring buffer's max_capacity {self.max_capacity}"
+            self.slabs = self._allocate(columns, max(self.capacity, n))
+            self.capacity = max(self.capacity, n)
+        if self.size + n > self.capacity:
+            self._grow(self.size + n)
+        tail = (self.head + self.size) % self.capacity
+        for slab_slice, data_slice in self._spans(tail, n):
+            for name, values in columns.items():
+                self.slabs[name][slab_slice] = values[data_slice]
+        self.size += n
+
+    def get(self, n):
+        # removes and returns the n oldest examples as contiguous arrays, one per column
+        assert n <= self.size, f"requested {n} examples but only {self.size} are buffered"
+        out = {name: np.empty((n, *slab.shape[1:]), dtype=slab.dtype) for name, slab in self.slabs.items()}
+        for slab_slice, data_slice in self._spans(self.head, n):
+            for name, slab in self.slabs.items():
+                out[name][data_slice] = slab[slab_slice]
+                if slab.dtype == object:
+                    # drop references so the strings can be freed
+                    slab[slab_slice] = None
+        self.head = (self.head + n) % self.capacity
+        self.size -= n
+        return out
+
+
+class RaggedRingBuffer:
+    """RingBuffer of examples that each own a variable number of rows, e.g. text embeddings at true length.
+
+    The rows of all examples are packed back to back into a second ring, so nothing is padded while buffered.
+    """
+
+    def __init__(self, capacity, row_capacity):
+        self.examples = RingBuffer(capacity)
+        self.rows = RingBuffer(row_capacity)
+
+    def __len__(self):
+        return len(self.examples)
+
+    def put(self, values, lengths, **columns):
+        # values: (sum(lengths), ...) rows of all examples, as packed by text_embeddings.to_ragged
+        self.examples.put(lengths=lengths, **columns)
+        self.rows.put(values=values)
+
+    def get(self, n):
+        batch = self.examples.get(n)
+        batch["values"] = self.rows.get(int(batch["lengths"].sum()))["values"]
+        return batch
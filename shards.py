@@ -0,0 +1,349 @@
+import json
+import os
+import shutil
+import struct
+
+import numpy as np
+import jax.numpy as jnp
+
+from text_embeddings import TEXT_LENGTH_BUCKETS, lengths_to_offsets, pad_embeddings, to_ragged
+
+SHARD_SUFFIX = ".shard"
+SHARD_MAGIC = b"IMGNSHRD"
+ALIGNMENT = 64
+
+# Shard file layout:
+#   magic | uint64 header length | json header | sections, each aligned to ALIGNMENT bytes
+# The header maps every section name to its offset, dtype and shape, so each section can be memory-mapped:
+#   images            uint8 (n, h, w, c), or for shards of encoded images:
+#   image_offsets     int64 (n + 1,), image i is image_data[image_offsets[i]:image_offsets[i + 1]]
+#   image_data        uint8 compressed (e.g. jpeg) bytes of every image, uncropped and of any size (the LAION
+#                     collector stores re-encoded draft decodes of about 256px on the short side)
+#   caption_offsets   int64 (n + 1,), caption i is captions[caption_offsets[i]:caption_offsets[i + 1]]
+#   captions          uint8 utf-8 bytes
+#   embedding_values  optional bf16 (total_tokens, dim), the valid tokens of every precomputed text embedding
+#   embedding_offsets optional int64 (n + 1,), embedding i is embedding_values[embedding_offsets[i]:embedding_offsets[i + 1]]
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _dtype_name(dtype):
+    # numpy describes bf16 as raw void bytes, so it is stored by name
+    return "bfloat16" if dtype.name == "bfloat16" else dtype.str
+
+
+def _dtype_from_name(name):
+    if name == "bfloat16":
+        return np.dtype(jnp.bfloat16)
+    return np.dtype(name)
+
+
+class ShardWriter:
+    """Writes fixed-size uint8 images, captions and optional text embeddings to a single shard file.
+
+    With image_shape=None the images are instead compressed bytes of any size (see image_processing.encode_image).
+    Images and embeddings are streamed to scratch files as they arrive, so only the captions are held in
+    memory. Embeddings are stored ragged, only their valid tokens in bf16. close() assembles the final
+    file next to the scratch files.
+    """
+
+    def __init__(self, path, image_shape=(256, 256, 3)):
+        self.path = path
+        self.image_shape = None if image_shape is None else tuple(image_shape)
+        self.images_file = open(path + ".images.tmp", "wb")
+        self.image_lengths = []
+        self.embeddings_file = None
+        self.embedding_dim = None
+        self.embedding_lengths = []
+        self.captions = []
+        self.caption_bytes = 0
+        self.num_examples = 0
+
+    def __len__(self):
+        return self.num_examples
+
+    @property
+    def nbytes(self):
+        # size of the shard so far, to rotate shards at a size threshold
+        nbytes = self.images_file.tell() + self.caption_bytes + 16 * self.num_examples
+        if self.embeddings_file is not None:
+            nbytes += self.embeddings_file.tell()
+        return nbytes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_batch(self, images, captions, embeddings=None, embedding_lengths=None):
+        if self.image_shape is not None:
+            images = np.ascontiguousarray(images, dtype=np.uint8)
+            assert images.shape[1:] == self.image_shape, f"expected images of shape {self.image_shape}, got {images.shape[1:]}"
+        assert len(images) == len(captions)
+        if self.num_examples > 0:
+            assert (embeddings is None) == (self.embeddings_file is None), "either every or no example has an embedding"
+        if embeddings is not None:
+            # padded (b, length, dim) embeddings with their valid lengths, or a list of unpadded ones
+            values, embedding_lengths = to_ragged(embeddings, embedding_lengths)
+            if self.embeddings_file is None:
+                self.embeddings_file = open(self.path + ".embeddings.tmp", "wb")
+                self.embedding_dim = values.shape[-1]
+            assert values.shape[-1] == self.embedding_dim
+            self.embeddings_file.write(values.tobytes())
+            self.embedding_lengths.extend(int(length) for length in embedding_lengths)
+        if self.image_shape is None:
+            for image in images:
+                self.images_file.write(image)
+                self.image_lengths.append(len(image))
+        else:
+            self.images_file.write(images.tobytes())
+        captions = [caption.encode("utf-8") for caption in captions]
+        self.captions.extend(captions)
+        self.caption_bytes += sum(len(caption) for caption in captions)
+        self.num_examples += len(images)
+
+    def add(self, image, caption, embedding=None, embedding_length=None):
+        self.add_batch(
+            [image] if self.image_shape is None else np.asarray(image)[None], [caption],
+            None if embedding is None else [np.asarray(embedding)[:embedding_length]])
+
+    def close(self):
+        if self.images_file.closed:
+            return
+        self.images_file.close()
+        if self.image_shape is None:
+            image_offsets = lengths_to_offsets(self.image_lengths)
+            sections = [
+                ("image_offsets", image_offsets.tobytes(), image_offsets.dtype, image_offsets.shape),
+                ("image_data", self.images_file.name, np.dtype(np.uint8), (int(image_offsets[-1]),)),
+            ]
+        else:
+            sections = [("images", self.images_file.name, np.dtype(np.uint8), (self.num_examples, *self.image_shape))]
+        caption_offsets = np.zeros(self.num_examples + 1, dtype=np.int64)
+        caption_offsets[1:] = np.cumsum([len(caption) for caption in self.captions])
+        captions = b"".join(self.captions)
+        sections.append(("caption_offsets", caption_offsets.tobytes(), caption_offsets.dtype, caption_offsets.shape))
+        sections.append(("captions", captions, np.dtype(np.uint8), (len(captions),)))
+        if self.embeddings_file is not None:
+            self.embeddings_file.close()
+            embedding_offsets = lengths_to_offsets(self.embedding_lengths)
+            sections.append(("embedding_values", self.embeddings_file.name, np.dtype(jnp.bfloat16), (int(embedding_offsets[-1]), self.embedding_dim)))
+            sections.append(("embedding_offsets", embedding_offsets.tobytes(), embedding_offsets.dtype, embedding_offsets.shape))
+
+        header = {"num_examples": self.num_examples, "sections": {}}
+        # the header size depends on the offsets it stores, so reserve generously and pad
+        offset = _align(len(SHARD_MAGIC) + 8 + 4096 + 256 * len(sections))
+        for name, _, dtype, shape in sections:
+            header["sections"][name] = {"offset": offset, "dtype": _dtype_name(dtype), "shape": list(shape)}
+            offset = _align(offset + int(np.prod(shape)) * dtype.itemsize)
+        header_bytes = json.dumps(header).encode("utf-8")
+        assert len(SHARD_MAGIC) + 8 + len(header_bytes) <= header["sections"][sections[0][0]]["offset"], "shard header too large"
+
+        with open(self.path + ".tmp", "wb") as f:
+            f.write(SHARD_MAGIC)
+            f.write(struct.pack("<Q", len(header_bytes)))
+            f.write(header_bytes)
+            for name, data, _, _ in sections:
+                f.seek(header["sections"][name]["offset"])
+                if isinstance(data, bytes):
+                    f.write(data)
+                else:
+                    with open(data, "rb") as section_file:
+                        shutil.copyfileobj(section_file, f, length=16 * 1024 * 1024)
+                    os.remove(data)
+            f.truncate(offset)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class ShardReader:
+    """Memory-maps a shard written by ShardWriter, samples are read on access without loading the file.
+
+    For shards of encoded images, `images` is None and batches hold the compressed bytes of every image.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            assert f.read(len(SHARD_MAGIC)) == SHARD_MAGIC, f"{path} is not a shard file"
+            header_length, = struct.unpack("<Q", f.read(8))
+            self.header = json.loads(f.read(header_length))
+        self.num_examples = self.header["num_examples"]
+        self.sections = {name: self._map(name) for name in self.header["sections"]}
+        self.images = self.sections.get("images")
+        self.encoded_images = self.images is None
+        self.embedding_values = self.sections.get("embedding_values")
+        self.embedding_offsets = self.sections.get("embedding_offsets")
+
+    def _map(self, name):
+        section = self.header["sections"][name]
+        shape = tuple(section["shape"])
+        dtype = _dtype_from_name(section["dtype"])
+        if int(np.prod(shape)) == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode="r", offset=section["offset"], shape=shape)
+
+    def __len__(self):
+        return self.num_examples
+
+    def caption(self, index):
+        offsets = self.sections["caption_offsets"]
+        return bytes(self.sections["captions"][offsets[index]:offsets[index + 1]]).decode("utf-8")
+
+    def captions(self, indices=None):
+        indices = range(self.num_examples) if indices is None else indices
+        return [self.caption(index) for index in indices]
+
+    def image_bytes(self, index):
+        offsets = self.sections["image_offsets"]
+        return bytes(self.sections["image_data"][offsets[index]:offsets[index + 1]])
+
+    def images_bytes(self, indices=None):
+        indices = range(self.num_examples) if indices is None else indices
+        return [self.image_bytes(index) for index in indices]
+
+    def get_batch(self, indices):
+        # sorted reads keep the page cache access sequential, the batch comes back in the requested order
+        indices = np.asarray(indices)
+        order = np.argsort(indices)
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        sorted_indices = indices[order]
+        batch = {
+            "images": self.images_bytes(indices) if self.encoded_images else np.asarray(self.images[sorted_indices])[inverse],
+            "texts": self.captions(indices),
+        }
+        if self.embedding_values is not None:
+            # ragged, padded once the whole batch is assembled
+            offsets = self.embedding_offsets
+            batch["embeddings"] = [np.asarray(self.embedding_values[offsets[index]:offsets[index + 1]]) for index in indices]
+        return batch
+
+
+def write_shard(path, images, captions, embeddings=None, embedding_lengths=None):
+    images = np.asarray(images, dtype=np.uint8)
+    with ShardWriter(path, image_shape=images.shape[1:]) as writer:
+        writer.add_batch(images, captions, embeddings, embedding_lengths)
+    return path
+
+
+def download_shard(storage, file, directory="shards"):
+    # copies a shard from a storage.Storage to local disk and memory-maps it
+    os.makedirs(directory, exist_ok=True)
+    return ShardReader(storage.download(file, os.path.join(directory, file["name"])))
+
+
+def list_shards(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(SHARD_SUFFIX))
+
+
+class ShardDataset:
+    """Random access over every example of a directory of shards, without loading them into memory.
+
+    Each epoch draws a global permutation of all example indices from (seed, epoch), so the order is
+    deterministic and independent of how many batches were drawn before. Batches are gathered from the
+    memory-mapped shards, so the dataset can be far larger than host memory. Text embeddings are padded
+    to the bucket of the batch's longest caption.
+
+    With bucket_by_length, batches are formed from captions of the same length bucket, so a batch of short
+    captions is not padded to the length of one long caption.
+    """
+
+    def __init__(self, paths, batch_size, seed=0, text_length_buckets=TEXT_LENGTH_BUCKETS, bucket_by_length=False):
+        self.shards = [ShardReader(path) for path in paths]
+        assert self.shards, "no shards to read from"
+        self.shard_offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.num_examples = int(self.shard_offsets[-1])
+        self.batch_size = batch_size
+        self.seed = seed
+        self.text_length_buckets = text_length_buckets
+        self.bucket_by_length = bucket_by_length and all(shard.embedding_offsets is not None for shard in self.shards)
+        self.epoch = 0
+        self.position = 0  # index of the next batch within the epoch
+        self._batches_epoch = None
+        self._batches = None
+
+    def __len__(self):
+        # batches per epoch, examples that do not fill a batch are dropped
+        return len(self.epoch_batches(self.epoch))
+
+    def state_dict(self):
+        # where the data order stands, the order itself is recomputed from (seed, epoch) without reading any data
+        return {
+            "seed": self.seed,
+            "epoch": self.epoch,
+            "position": self.position,
+            "num_examples": self.num_examples,
+            "batch_size": self.batch_size,
+            "bucket_by_length": self.bucket_by_length,
+        }
+
+    def load_state_dict(self, state):
+        # the next batch served is the first one not served before the state was saved
+        expected = (self.num_examples, self.batch_size, self.bucket_by_length)
+        saved = (state["num_examples"], state["batch_size"], state["bucket_by_length"])
+        assert saved == expected, f"data state of a different dataset: {saved} != {expected}"
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+        self.position = state["position"]
+        self._batches_epoch = None
+
+    def text_lengths(self):
+        return np.concatenate([np.diff(shard.embedding_offsets) for shard in self.shards])
+
+    def epoch_batches(self, epoch):
+        # the example indices of every batch of the epoch, in the order they are served
+        if self._batches_epoch == epoch:
+            return self._batches
+        rng = np.random.default_rng([self.seed, epoch])
+        permutation = rng.permutation(self.num_examples)
+        if not self.bucket_by_length:
+            batches = [permutation[start:start + self.batch_size] for start in range(0, len(permutation) - self.batch_size + 1, self.batch_size)]
+        else:
+            buckets = np.searchsorted(np.asarray(self.text_length_buckets), self.text_lengths()[permutation])
+            buckets = np.minimum(buckets, len(self.text_length_buckets) - 1)
+            batches = []
+            leftover = permutation[:0]
+            for bucket in range(len(self.text_length_buckets)):
+                # what does not fill a batch in its bucket moves up to the next, longer bucket
+                indices = np.concatenate([leftover, permutation[buckets == bucket]])
+                num_full = len(indices) // self.batch_size * self.batch_size
+                if num_full > 0:
+                    batches.extend(np.split(indices[:num_full], num_full // self.batch_size))
+                leftover = indices[num_full:]
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        self._batches_epoch, self._batches = epoch, batches
+        return batches
+
+    def get_batch(self, indices):
+        indices = np.asarray(indices)
+        shard_ids = np.searchsorted(self.shard_offsets, indices, side="right") - 1
+        parts = []
+        for shard_id in np.unique(shard_ids):
+            positions = np.nonzero(shard_ids == shard_id)[0]
+            parts.append((positions, self.shards[shard_id].get_batch(indices[positions] - self.shard_offsets[shard_id])))
+        batch = {}
+        for name, values in parts[0][1].items():
+            if isinstance(values, list):
+                batch[name] = [None] * len(indices)
+                for positions, part in parts:
+                    for position, value in zip(positions, part[name]):
+                        batch[name][position] = value
+            else:
+                batch[name] = np.empty((len(indices), *values.shape[1:]), dtype=values.dtype)
+                for positions, part in parts:
+                    batch[name][positions] = part[name]
+        return batch
+
+    def next_batch(self):
+        if self.position >= len(self):
+            self.epoch += 1
+            self.position = 0
+        indices = self.epoch_batches(self.epoch)[self.position]
+        self.position += 1
+        batch = self.get_batch(indices)
+        if "embeddings" in batch:
+            batch["embeddings"], batch["attention_masks"] = pad_embeddings(batch["embeddings"], buckets=self.text_length_buckets)
+        return batch
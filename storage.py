@@ -0,0 +1,251 @@
+import contextlib
+import fcntl
+import functools
+import hashlib
+import io
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def _chunks(size, chunk_size):
+    return [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+
+class Storage:
+    """A flat folder of objects. Files are described by dicts with "id", "name" and "size", as Drive lists them.
+
+    Subclasses implement list, size, read_range and upload. Whole objects are read as many ranged requests
+    in parallel, so a large shard downloads at the available bandwidth instead of one request's.
+    """
+
+    def __init__(self, num_threads=8, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+
+    def _size(self, file):
+        return int(file["size"]) if file.get("size") is not None else self.size(file)
+
+    def read(self, file):
+        buffer = bytearray(self._size(file))
+
+        def read_chunk(chunk):
+            start, stop = chunk
+            buffer[start:stop] = self.read_range(file, start, stop)
+
+        list(self.executor.map(read_chunk, _chunks(len(buffer), self.chunk_size)))
+        return buffer
+
+    def download(self, file, path):
+        # chunks are written at their offsets as they arrive, the file appears under path once complete
+        size = self._size(file)
+        with open(path + ".tmp", "wb") as f:
+            f.truncate(size)
+            list(self.executor.map(lambda chunk: os.pwrite(f.fileno(), self.read_range(file, *chunk), chunk[0]), _chunks(size, self.chunk_size)))
+        os.replace(path + ".tmp", path)
+        return path
+
+
+class LocalStorage(Storage):
+    """Stand-in for Drive: every object is a file in `directory`, uploads become visible atomically."""
+
+    def __init__(self, directory, num_threads=8, chunk_size=CHUNK_SIZE):
+        super().__init__(num_threads, chunk_size)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def list(self):
+        return [
+            {"id": os.path.join(self.directory, name), "name": name, "size": os.path.getsize(os.path.join(self.directory, name))}
+            for name in sorted(os.listdir(self.directory)) if not name.endswith(".tmp")]
+
+    def size(self, file):
+        return os.path.getsize(file["id"])
+
+    def read_range(self, file, start, stop):
+        with open(file["id"], "rb") as f:
+            return os.pread(f.fileno(), stop - start, start)
+
+    def upload(self, path, name):
+        # parallel chunked copy
+        destination = os.path.join(self.directory, name)
+        size = os.path.getsize(path)
+        with open(path, "rb") as source, open(destination + ".tmp", "wb") as f:
+            f.truncate(size)
+            list(self.executor.map(
+                lambda chunk: os.pwrite(f.fileno(), os.pread(source.fileno(), chunk[1] - chunk[0], chunk[0]), chunk[0]),
+                _chunks(size, self.chunk_size)))
+        os.replace(destination + ".tmp", destination)
+
+    def upload_bytes(self, data, name):
+        destination = os.path.join(self.directory, name)
+        with open(destination + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(destination + ".tmp", destination)
+
+
+class DriveStorage(Storage):
+    """A Google Drive folder, given by its id or by the name of a shared drive.
+
+    Every thread builds its own Drive service once and reuses it (the underlying http client is not thread
+    safe). Uploads are resumable and sent in chunks straight from disk, Drive accepts the chunks of one
+    upload only in order.
+    """
+
+    def __init__(self, folder_id=None, shared_drive_name=None, token_file="token.json", num_threads=8, chunk_size=CHUNK_SIZE):
+        super().__init__(num_threads, chunk_size)
+        self.creds = Credentials.from_authorized_user_file(token_file, scopes=["https://www.googleapis.com/auth/drive"])
+        self.local = threading.local()
+        if shared_drive_name is not None:
+            results = self.service.files().list(
+                q=f"name='{shared_drive_name}'",
+                fields="nextPageToken, files(id, name)",
+                includeItemsFromAllDrives=True,
+                supportsAllDrives=True,
+                corpora="allDrives").execute()
+            folder_id = results["files"][0]["id"]
+        self.folder_id = folder_id
+
+    @property
+    def service(self):
+        if not hasattr(self.local, "service"):
+            self.local.service = build("drive", "v3", credentials=self.creds, cache_discovery=False)
+        return self.local.service
+
+    def list(self):
+        # errors propagate, an empty or partial listing would look like missing files
+        files = []
+        page_token = None
+        while True:
+            response = self.service.files().list(q=f"'{self.folder_id}' in parents",
+                                                 fields='nextPageToken, files(id, name, mimeType, size)',
+                                                 includeItemsFromAllDrives=True,
+                                                 supportsAllDrives=True,
+                                                 corpora="allDrives",
+                                                 pageToken=page_token).execute()
+            files.extend(response.get('files', []))
+            page_token = response.get('nextPageToken', None)
+            if page_token is None:
+                break
+        return files
+
+    def size(self, file):
+        return int(self.service.files().get(fileId=file["id"], fields="size", supportsAllDrives=True).execute()["size"])
+
+    def read_range(self, file, start, stop):
+        request = self.service.files().get_media(fileId=file["id"], supportsAllDrives=True)
+        request.headers["Range"] = f"bytes={start}-{stop - 1}"
+        return request.execute()
+
+    def _create(self, name, media):
+        # an HttpError propagates, callers delete their local copy only once an upload returned
+        file = self.service.files().create(
+            body={"name": name, "parents": [self.folder_id]}, media_body=media, fields="id", supportsAllDrives=True).execute()
+        print(f"File uploaded: {name} with ID: {file.get('id')}")
+
+    def upload(self, path, name):
+        self._create(name, MediaFileUpload(path, mimetype="application/octet-stream", resumable=True, chunksize=self.chunk_size))
+
+    def upload_bytes(self, data, name):
+        self._create(name, MediaIoBaseUpload(io.BytesIO(data), mimetype="application/octet-stream", resumable=True, chunksize=self.chunk_size))
+
+
+@functools.lru_cache(maxsize=None)
+def drive_storage(folder_id=None, shared_drive_name=None):
+    # one client per folder and process, instead of a new Drive service per call
+    return DriveStorage(folder_id, shared_drive_name)
+
+
+@contextlib.contextmanager
+def _locked(path):
+    # exclusive lock between the processes of one host
+    with open(path, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class ShardCache:
+    """Host-local, size bounded cache of files from a Storage, shared by every process on the node.
+
+    get() downloads a file on its first use and returns the local path, later epochs read it from local disk.
+    A file's mtime records its last use, once the cache grows past max_bytes the least recently used files
+    are deleted. A lock per file keeps workers from downloading the same file at once, and downloads only
+    appear under their final name once complete. Deleting a file does not invalidate memory maps readers
+    already hold, and files used within grace_seconds are never evicted, so a returned path stays openable.
+    """
+
+    def __init__(self, storage, directory, max_bytes, grace_seconds=600):
+        self.storage = storage
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.grace_seconds = grace_seconds
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, file):
+        return os.path.join(self.directory, hashlib.sha1(file["id"].encode("utf-8")).hexdigest()[:16] + "_" + file["name"])
+
+    def get(self, file):
+        path = self.path(file)
+        with _locked(path + ".lock"):
+            downloaded = not os.path.exists(path)
+            if downloaded:
+                self.storage.download(file, path)
+                self.misses += 1
+            else:
+                self.hits += 1
+            os.utime(path)
+        if downloaded:
+            self.evict()
+        return path
+
+    def evict(self):
+        with _locked(os.path.join(self.directory, ".lock")):
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.startswith(".") or name.endswith((".tmp", ".lock")):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(self.directory, name)))
+            total = sum(size for _, size, _ in entries)
+            now = time.time()
+            for mtime, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if now - mtime < self.grace_seconds:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+def prefetch(fn, items, depth=2):
+    """Yields fn(item) for every item in order, while fn already runs on the next `depth` items.
+
+    With fn a download, the next files transfer while the current one is processed.
+    """
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) > depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
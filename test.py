@@ -3,57 +3,25 @@ import pickle
 import time
 import random
 import time
-from googleapiclient import errors
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
 import io
 import cv2
 import numpy as np
 import ray
 import T5Utils
 import logging
+from storage import drive_storage, prefetch
 os.environ["TCMALLOC_LARGE_ALLOC_REPORT_THRESHOLD"] = "2000000000000"
 
 # ray.init(logging_level=logging.ERROR, log_to_driver=False)
 
-creds = Credentials.from_authorized_user_file(
-            'token.json',
-            scopes=["https://www.googleapis.com/auth/drive"]
-        )
-
+DATASET_FOLDER = "1QwRiS6rIfWPrzrVBU9x1Y8S6kHXKZnvN"
 
 
 def list_files():
-    drive_service = build('drive', 'v3', credentials=creds)
-    files = []
-    try:
-        page_token = None
-        while True:
-            query = "'1QwRiS6rIfWPrzrVBU9x1Y8S6kHXKZnvN' in parents"
-            response = drive_service.files().list(q=f"{query}",
-                                                  fields='nextPageToken, '
-                                                  'files(id, name, mimeType)',
-                                                  includeItemsFromAllDrives=True,
-                                                  supportsAllDrives=True, 
-                                                  corpora="allDrives",
-                                                  pageToken=page_token).execute()
-            for file in response.get('files', []):
-                # Process the file
-                files.append(file)
-                # print(F'Found file: {file.get("name")} ({file.get("id")})')
-                
-            page_token = response.get('nextPageToken', None)
-            if page_token is None:
-                break
-    except errors.HttpError as error:
-        print(F'An error occurred: {error}')
-        files = None
-    return files
+    return drive_storage(DATASET_FOLDER).list()
 
 def download_pickle(file):
-    drive_service = build('drive', 'v3', credentials=creds)
-    request = drive_service.files().get_media(fileId=file.get('id')).execute()
-    data = pickle.load(io.BytesIO(request))
+    data = pickle.loads(drive_storage(DATASET_FOLDER).read(file))
     return data
 
 def reqDownload():
@@ -62,6 +30,13 @@ def reqDownload():
         data = download_pickle(file)
         print("Requst Download", time.time() - st)
         image, text = data
+def prefetchDownload():
+    # the next files download while the current one is unpickled
+    st = time.time()
+    for data in prefetch(download_pickle, list_files()):
+        print("Prefetched Download", time.time() - st)
+        image, text = data
+        st = time.time()
 def mount():
     for file in os.listdir('drive'):
         if file.endswith('.pkl'):
@@ -0,0 +1,54 @@
+import numpy as np
+import jax.numpy as jnp
+
+# text lengths a batch is padded to, longer captions are cut to the last bucket (UnetConfig.max_token_len)
+TEXT_LENGTH_BUCKETS = (32, 64, 128, 256)
+
+
+def bucket_length(length, buckets=TEXT_LENGTH_BUCKETS):
+    for bucket in buckets:
+        if length <= bucket:
+            return bucket
+    return buckets[-1]
+
+
+def to_ragged(embeddings, lengths=None):
+    """Packs embeddings into one (total_tokens, dim) bf16 array of their valid tokens.
+
+    embeddings is either a padded (b, length, dim) array with the number of valid tokens per example in
+    `lengths`, or a list of (length_i, dim) arrays. Returns the packed values and the per-example lengths.
+    """
+    if lengths is None:
+        lengths = [len(embedding) for embedding in embeddings]
+    else:
+        embeddings = [embedding[:length] for embedding, length in zip(embeddings, lengths)]
+    lengths = np.asarray(lengths, dtype=np.int64)
+    values = np.concatenate([np.asarray(embedding) for embedding in embeddings], axis=0).astype(jnp.bfloat16)
+    return values, lengths
+
+
+def lengths_to_offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    return offsets
+
+
+def pad_embeddings(embeddings, pad_to=None, buckets=TEXT_LENGTH_BUCKETS):
+    """Pads a list of (length_i, dim) embeddings into a (b, pad_to, dim) batch and its attention mask.
+
+    pad_to defaults to the bucket of the longest example in the batch.
+    """
+    lengths = np.asarray([len(embedding) for embedding in embeddings])
+    if pad_to is None:
+        pad_to = bucket_length(int(lengths.max()), buckets)
+    batch = np.zeros((len(embeddings), pad_to, embeddings[0].shape[-1]), dtype=embeddings[0].dtype)
+    for i, embedding in enumerate(embeddings):
+        batch[i, :min(lengths[i], pad_to)] = embedding[:pad_to]
+    attention_mask = np.arange(pad_to)[None, :] < np.minimum(lengths, pad_to)[:, None]
+    return batch, attention_mask.astype(np.int32)
+
+
+def pad_ragged(values, lengths, pad_to=None, buckets=TEXT_LENGTH_BUCKETS):
+    # same as pad_embeddings for embeddings packed by to_ragged
+    embeddings = np.split(values, lengths_to_offsets(lengths)[1:-1])
+    return pad_embeddings(embeddings, pad_to, buckets)